@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+# Create Time: 2026/10/18
+
+# offline benchmark of the hot paths of `sodayo.py`, over in-process simulated hosts (HOST_BACKEND = 'sim')
+#   python3 bench.py                                     # at 10/100/1000 hosts
+#   python3 bench.py --hosts 100 --save base.json        # keep the results as a baseline
+#   python3 bench.py --hosts 100 --compare base.json     # report regressions against it, exit 1 if any
+
+import os
+import sys
+import json
+from argparse import ArgumentParser
+from tempfile import TemporaryDirectory
+from time import monotonic
+from random import Random
+from hashlib import sha256
+
+import numpy as np
+
+import sodayo
+
+
+PASSWORD = 'bench'
+PERCENTILES = [50, 90, 99]
+
+
+def setup(n_hosts:int, args, workdir:str) -> sodayo.GpuMonitor:
+  users = [f'user{i:03d}' for i in range(args.users)]
+  with open(os.path.join(workdir, 'quota_init.txt'), 'w', encoding='utf8') as fh:
+    for username in users:
+      fh.write(f'{username} 1000\n')
+
+  # NOTE: settings are read from module globals of `sodayo` at runtime, so just override them there
+  overrides = {
+    'BASE_PATH':          workdir,
+    'QUOTA_INIT_FILE':    'quota_init.txt',
+    'DATA_PATH':          'data',
+    'HISTORY_PATH':       args.no_history and None or 'history',
+    'HOST_BACKEND':       'sim',
+    'SIM_USERS':          users + ['root'],     # someone untracked, too
+    'SIM_LATENCY':        tuple(args.latency),
+    'SIM_FAIL_RATE':      args.fail_rate,
+    'SIM_SEED':           args.seed,
+    'GPUSTAT_AGENT':      False,
+    'AUTH_VERIFIER':      'static',
+    'AUTH_STATIC_PASSWD': {username: sha256(PASSWORD.encode()).hexdigest() for username in users},
+    'LOG_FILE':           None,
+    'DEBUG_MODE':         False,
+  }
+  for k, v in overrides.items():
+    setattr(sodayo, k, v)
+  sodayo.TRACKED_SOCKETS[:] = [(f'sim{i:04d}', 22) for i in range(n_hosts)]
+
+  # start over from a clean state
+  for states in [sodayo.host_resolv, sodayo.gpu_runtime, sodayo.gpu_stats, sodayo.gpu_topology, sodayo.host_locks]:
+    states.clear()
+
+  sodayo.init_logger()
+  sodayo.logger.setLevel(args.verbose and 'INFO' or 'ERROR')
+  monitor = sodayo.monitor = sodayo.GpuMonitor()
+  # NOTE: not `monitor.start()`, no background timers to disturb the timing
+  monitor.quota_tracker.start()
+  monitor.publish()
+  monitor.backend.start()
+  monitor.sync()    # warm up
+  return monitor
+
+
+def measure(fn, rounds:int) -> np.ndarray:
+  costs = [ ]
+  for i in range(rounds):
+    start = monotonic()
+    fn(i)
+    costs.append(monotonic() - start)
+  return np.array(costs)
+
+
+def run(n_hosts:int, args) -> dict:
+  with TemporaryDirectory(prefix='sodayo-bench-') as workdir:
+    monitor = setup(n_hosts, args, workdir)
+    client = sodayo.app.test_client()
+    random = Random(args.seed)
+
+    def dequota_task(i):
+      # NOTE: only the hosts due are polled, so make them all due, as it is at the start or after a long idle
+      with monitor.poller.lock:
+        monitor.poller.heap.clear()
+        monitor.poller.deadline.clear()
+        for sock in sodayo.TRACKED_SOCKETS:
+          monitor.poller._schedule(sock, 0)
+      monitor.dequota_task()
+      monitor.check_timer.cancel()    # it re-arms itself
+
+    def alloc_gpu(i):
+      username = f'user{random.randrange(args.users):03d}'
+      r = monitor.alloc_gpu(username, PASSWORD, random.randint(1, 4))
+      if type(r) == dict:             # give back, so the cluster won't run out along rounds
+        with sodayo.index_lock:
+          monitor.alloc_index.release(r['hostname'], r['gpu_ids'])
+
+    def get(url:str):
+      def fn(i):
+        assert client.get(url).status_code in [200, 304]
+      return fn
+
+    cases = {
+      'sync':           lambda i: monitor.sync(),
+      'dequota_task':   dequota_task,
+      'GET /runtime':   get('/runtime'),
+      'GET /quota':     get('/quota'),
+      'GET /quota?username': get('/quota?username=user000'),
+      'GET /runtime?filter': get('/runtime?min_free=1&max_util=50&fields=users,utilization.gpu'),
+      'GET /quota?filter': get('/quota?below=1000&fields=remnant,used'),
+      'GET /metrics':   get('/metrics'),
+      'GET /report':    get('/report'),
+      'alloc_gpu':      alloc_gpu,      # NOTE: last, as preemption triggers syncs in background
+    }
+
+    results = { }
+    try:
+      for name, fn in cases.items():
+        if args.cases and name not in args.cases: continue
+        costs = measure(fn, args.rounds)
+        results[f'{n_hosts}/{name}'] = {
+          'rounds': len(costs),
+          'mean': float(costs.mean()),
+          'max': float(costs.max()),
+          **{f'p{p}': float(v) for p, v in zip(PERCENTILES, np.percentile(costs, PERCENTILES))},
+        }
+    finally:
+      monitor.stop()
+    return results
+
+
+def report(results:dict, baseline:dict=None, threshold:float=0.2, floor:float=0.001) -> list:
+  ''' print a table in ms, return names of the regressed cases '''
+
+  keys = ['mean'] + [f'p{p}' for p in PERCENTILES] + ['max']
+  print(f'{"case".ljust(32)}' + ''.join(k.rjust(10) for k in keys) + ('  vs baseline' if baseline else ''))
+
+  regressed = [ ]
+  for name, r in results.items():
+    line = name.ljust(32) + ''.join(f'{r[k] * 1000:10.2f}' for k in keys)
+    base = baseline and baseline.get(name)
+    if base:
+      # slower by both a ratio and an absolute floor, to keep from flagging noise on tiny costs
+      worse = [k for k in ['p50', 'p99'] if r[k] > base[k] * (1 + threshold) and r[k] - base[k] > floor]
+      line += '  ' + ' '.join(f'{k} {r[k] / max(base[k], 1e-9) - 1:+.0%}' for k in ['p50', 'p99'])
+      if worse:
+        line += '  REGRESSION'
+        regressed.append(name)
+    print(line)
+  return regressed
+
+
+if __name__ == '__main__':
+  parser = ArgumentParser()
+  parser.add_argument('--hosts',     type=int, nargs='+', default=[10, 100, 1000], help='cluster scales to run at')
+  parser.add_argument('--rounds',    type=int,   default=20,             help='rounds of each case')
+  parser.add_argument('--cases',     type=str,   nargs='+',              help='only run these cases, eg. sync alloc_gpu')
+  parser.add_argument('--users',     type=int,   default=50,             help='users in the quota rules')
+  parser.add_argument('--latency',   type=float, nargs=2, default=[0.001, 0.005], help='simulated latency range of host access, in seconds')
+  parser.add_argument('--fail-rate', type=float, default=0.0,            help='simulated failure rate of host access')
+  parser.add_argument('--seed',      type=int,   default=0)
+  parser.add_argument('--no-history', action='store_true',              help='disable the history store')
+  parser.add_argument('--save',      type=str,                           help='save results to this json file as a baseline')
+  parser.add_argument('--compare',   type=str,                           help='compare with the baseline json file')
+  parser.add_argument('--threshold', type=float, default=0.2,            help='slower than the baseline by this ratio is a regression')
+  parser.add_argument('--verbose',   action='store_true',               help='show logs of sodayo')
+  args = parser.parse_args()
+
+  results = { }
+  for n_hosts in args.hosts:
+    print(f'[bench] {n_hosts} hosts x {sodayo.SIM_GPUS} GPUs ...', file=sys.stderr)
+    results.update(run(n_hosts, args))
+
+  baseline = None
+  if args.compare:
+    with open(args.compare, 'r', encoding='utf8') as fh:
+      baseline = json.load(fh)
+  regressed = report(results, baseline, args.threshold)
+
+  if args.save:
+    with open(args.save, 'w', encoding='utf8') as fh:
+      json.dump(results, fh, indent=2)
+
+  if regressed:
+    print(f'[bench] {len(regressed)} regression(s): {", ".join(regressed)}', file=sys.stderr)
+    sys.exit(1)
@@ -3,7 +3,12 @@
 # Create Time: 2021/09/24 
 
 import os
+import sys
+import csv
+import json
+from time import sleep
 from pwd import getpwuid
+from datetime import datetime
 from argparse import ArgumentParser
 
 import requests as R
@@ -13,36 +18,168 @@ from settings import *
 
 __version__ = '0.1'     # 2021/09/26
 
+session = R.Session()     # NOTE: one keep-alive connection for all requests, eg. along `--watch`
+
+
+def fetch(path, params=None, watch=False):
+  ''' yield the response of GET `path` once, or on each change if `watch`, by long-poll with conditional requests '''
+  params, etag = dict(params or {}), None
+  if watch: params['wait'] = LONGPOLL_TIMEOUT
+  while True:
+    try:
+      r = session.get(f'{API_BASE}{path}', params=params, headers=etag and {'If-None-Match': etag} or {}, timeout=LONGPOLL_TIMEOUT + 30)
+    except R.RequestException as e:
+      if not watch: raise
+      print(f'[error] {e}, retry later', file=sys.stderr)
+      sleep(5)
+      continue
+    if r.status_code != 304:    # not changed till the server-side timeout
+      d = r.json()
+      if not d["ok"]:
+        print(f'[error] {d["reason"]}')
+        return
+      etag = r.headers.get('ETag')
+      yield d
+    if not watch: return
+
+
+def output(header, rows, fmt, first=True):
+  # machine-readable tables, NOTE: csv header only once along `--watch`
+  if fmt == 'csv':
+    writer = csv.writer(sys.stdout)
+    if first: writer.writerow(header)
+    writer.writerows(rows)
+  else:
+    print(json.dumps([dict(zip(header, row)) for row in rows]))
+  sys.stdout.flush()
+
 
 def sync():
   try:
-    d = R.put(f'{API_BASE}/sync', timeout=30).json()
+    d = session.put(f'{API_BASE}/sync', timeout=30).json()
     if d["ok"]: print('ok')
     else:      print(f'[error] {d["reason"]}')
   except Exception as e:
     print(e)
 
 
-def runtime():
+def runtime(params=None, fmt='text', watch=False):
+  fields = params and params.get('fields') and params['fields'].split(',')
   try:
-    d = R.get(f'{API_BASE}/runtime').json()
-    if d["ok"]:
+    for i, d in enumerate(fetch('/runtime', params, watch)):
+      stale = d.get("stale", {})    # restored from the server's checkpoint, not refreshed yet
+      if fmt != 'text':
+        rows = [ ]
+        for hostname, gpu_rt in d["data"].items():
+          for gpu_id, card in gpu_rt.items():
+            card = fields and card or {'users': card}
+            rows.append([hostname, int(gpu_id)] + [';'.join(v) if k == 'users' else v for k, v in card.items()] + [hostname in stale])
+        output(['host', 'gpu'] + sorted(fields or ['users']) + ['stale'], rows, fmt, i == 0)
+        continue
+
+      if watch: print(f'--- {datetime.now():%Y-%m-%d %H:%M:%S}')
       for hostname, gpu_rt in d["data"].items():
-        print(f'<{hostname}>')
-        for gpu_id, users in gpu_rt.items():
-          print(f'  [{gpu_id}]: {",".join(sorted(users))}')
+        if hostname in stale: print(f'<{hostname}> (stale, seen at {datetime.fromtimestamp(stale[hostname]):%Y-%m-%d %H:%M:%S})')
+        else:                 print(f'<{hostname}>')
+        for gpu_id, card in gpu_rt.items():
+          if fields: print(f'  [{gpu_id}]: ' + '  '.join(f'{k} {",".join(v) if k == "users" else v}' for k, v in card.items()))
+          else:      print(f'  [{gpu_id}]: {",".join(sorted(card))}')
+      sys.stdout.flush()
+  except KeyboardInterrupt:
+    pass
+  except Exception as e:
+    print(e)
+
+
+def quota(params=None, fmt='text', watch=False):
+  fields = params and params.get('fields') and params['fields'].split(',')
+  try:
+    for i, d in enumerate(fetch('/quota', params, watch)):
+      if fmt != 'text':
+        rows = [[k] + (fields and list(v.values()) or [v]) for k, v in d["data"].items()]
+        output(['username'] + sorted(fields or ['remnant']), rows, fmt, i == 0)
+        continue
+
+      if watch: print(f'--- {datetime.now():%Y-%m-%d %H:%M:%S}')
+      for k, v in d["data"].items():
+        if fields: print(f'{(k + ":").ljust(10)}' + '  '.join(f'{f} {x if x is None else round(x, 4)}' for f, x in v.items()))
+        else:      print(f'{(k + ":").ljust(10)}{v:.2f} hours')    # NOTE: maxlen of username is about 7
+      sys.stdout.flush()
+  except KeyboardInterrupt:
+    pass
+  except Exception as e:
+    print(e)
+
+
+def reload_quota():
+  try:
+    d = session.post(f'{API_BASE}/quota/reload', headers={'X-Admin-Secret': ADMIN_SECRET or ''}, timeout=30).json()
+    if d["ok"]:
+      diff = d["data"]
+      for k, v in diff["added"].items():   print(f'+ {(k + ":").ljust(10)}{v:.2f} hours')
+      for k in diff["removed"]:            print(f'- {k}')
+      for k, v in diff["changed"].items(): print(f'~ {(k + ":").ljust(10)}{v:+.2f} hours')
+      if not any(diff.values()): print('no change')
     else:
       print(f'[error] {d["reason"]}')
   except Exception as e:
     print(e)
 
 
-def quota(username=None):
+def adjust_quota(items, reason=None):
+  try:
+    deltas = { }
+    for item in items:      # eg. 'somebody=+10', 'somebody=-2.5'
+      k, v = item.split('=')
+      deltas[k] = deltas.get(k, 0) + float(v)
+  except ValueError:
+    print('[error] expect items like username=+hours or username=-hours')
+    return
+
   try:
-    d = R.get(f'{API_BASE}/quota' + (username and f'?username={username}' or '')).json()
+    d = session.post(f'{API_BASE}/quota/adjust', json={'deltas': deltas, 'reason': reason},
+               headers={'X-Admin-Secret': ADMIN_SECRET or ''}, timeout=30).json()
     if d["ok"]:
       for k, v in d["data"].items():
-        print(f'{(k + ":").ljust(10)}{v:.2f} hours')    # NOTE: maxlen of username is about 7
+        print(f'{(k + ":").ljust(10)}{v:.2f} hours ({deltas[k]:+.2f})')
+    else:
+      print(f'[error] {d["reason"]}')
+  except Exception as e:
+    print(e)
+
+
+def history(host=None, gpu=None, user=None, since=None, until=None):
+  params = {k: v for k, v in {'host': host, 'gpu': gpu, 'user': user, 'since': since, 'until': until}.items() if v is not None}
+  try:
+    d = session.get(f'{API_BASE}/history', params=params, timeout=60).json()
+    if d["ok"]:
+      cols = d["data"]
+      for i in range(len(cols['ts'])):
+        ts = datetime.fromtimestamp(cols['ts'][i]).strftime('%Y-%m-%d %H:%M:%S')
+        print(f'{ts}  <{cols["host"][i]}> [{cols["gpu"][i]}] {(cols["user"][i] or "-").ljust(10)}'
+              f'{cols["util"][i]:>3}%  {cols["mem_used"][i]:>6}/{cols["mem_total"][i]} MiB')
+    else:
+      print(f'[error] {d["reason"]}')
+  except Exception as e:
+    print(e)
+
+
+def report(days=None):
+  try:
+    d = session.get(f'{API_BASE}/report', params=days and {'days': days} or {}, timeout=60).json()
+    if d["ok"]:
+      data = d["data"]
+      print(f'[users] burn rate over last {data["window"]["days"]:g} day(s), ranked by fair share')
+      for username, u in sorted(data["users"].items(), key=lambda x: x[1]["rank"]):
+        exhaust = u["exhaust_ts"] and datetime.fromtimestamp(u["exhaust_ts"]).strftime('%Y-%m-%d %H:%M') if u["exhaust_before_reset"] else '-'
+        print(f'  #{u["rank"]:<3}{username.ljust(10)}used {u["used"] or 0:>8.2f}/{u["allotment"] or 0:<8.2f}'
+              f'share {u["share_actual"] or 0:>6.1%}/{u["share_target"] or 0:<6.1%} burn {u["burn_rate"] or 0:>6.2f}h/d  exhaust {exhaust}')
+      print('[hosts] usage in window')
+      for hostname, hours in data["hosts"].items():
+        print(f'  <{hostname}> {hours:.2f} hours')
+      print('[months] usage')
+      for month, usage in data["months"].items():
+        print(f'  {month}: ' + ', '.join(f'{k} {v:.2f}' for k, v in sorted(usage.items())))
     else:
       print(f'[error] {d["reason"]}')
   except Exception as e:
@@ -53,13 +190,38 @@ if __name__ == '__main__':
   parser = ArgumentParser()
   parser.add_argument('--sync',    action='store_true',   help='force sync data from all hosts')
   parser.add_argument('--runtime', action='store_true',   help='show latest runtime info')
-  parser.add_argument('--quota', type=str, default='@me', help='query quota remnants, eg. --quota @me/@all/somebody')
+  parser.add_argument('--quota', type=str, default='@me', help='query quota remnants, eg. --quota @me/@all/somebody/alice,bob')
+  parser.add_argument('--below', type=float,              help='quota filter: remnant below these hours')
+  parser.add_argument('--above', type=float,              help='quota filter: remnant above these hours')
+  parser.add_argument('--min-free', type=int,             help='runtime filter: hosts with at least such many GPUs without process')
+  parser.add_argument('--max-util', type=float,           help='runtime filter: GPUs with utilization (%%) not above')
+  parser.add_argument('--max-mem', type=float,            help='runtime filter: GPUs with memory used (MiB) not above')
+  parser.add_argument('--fields', type=str,               help='runtime: users,memory.used,memory.total,utilization.gpu; quota: remnant,allotment,used,priority')
+  parser.add_argument('--watch', action='store_true',     help='keep showing runtime/quota on each change, till Ctrl+C')
+  parser.add_argument('--format', type=str, default='text', choices=['text', 'json', 'csv'], help='output format of runtime/quota')
+  parser.add_argument('--history', action='store_true',   help='show runtime history, filtered by --host/--gpu/--user/--since/--until')
+  parser.add_argument('--reload-quota', action='store_true', help='[admin] apply the modified quota rules file now')
+  parser.add_argument('--adjust-quota', type=str, nargs='+', metavar='USER=HOURS', help='[admin] grant (+) or debit (-) hours to users at once, eg. alice=+10 bob=-2')
+  parser.add_argument('--reason', type=str,               help='[admin] why to adjust, for the server log')
+  parser.add_argument('--report',  action='store_true',   help='show usage report, with burn rate over last --days')
+  parser.add_argument('--days',  type=float,              help='report window in days, default by server')
+  parser.add_argument('--host',  type=str,                help='history/runtime filter: hostname, runtime takes a list like h1,h2')
+  parser.add_argument('--gpu',   type=int,                help='history filter: gpu id')
+  parser.add_argument('--user',  type=str,                help='history/runtime filter: username, @me for yourself, runtime takes a list like alice,bob')
+  parser.add_argument('--since', type=str,                help='history filter: timestamp or isoformat, default 24 hours ago')
+  parser.add_argument('--until', type=str,                help='history filter: timestamp or isoformat, default now')
   args = parser.parse_args()
 
   username = getpwuid(os.getuid()).pw_name
+  user = args.user == '@me' and username or args.user
   if args.sync: sync()
-  elif args.runtime: runtime()
+  elif args.runtime:
+    params = {'host': args.host, 'user': user, 'min_free': args.min_free, 'max_util': args.max_util, 'max_mem': args.max_mem, 'fields': args.fields}
+    runtime({k: v for k, v in params.items() if v is not None}, args.format, args.watch)
+  elif args.report: report(args.days)
+  elif args.reload_quota: reload_quota()
+  elif args.adjust_quota: adjust_quota(args.adjust_quota, args.reason)
+  elif args.history: history(args.host, args.gpu, user, args.since, args.until)
   elif args.quota:
-    if args.quota == '@all': quota()
-    elif args.quota == '@me': quota(username)
-    else: quota(args.quota)
+    params = {'username': {'@all': None, '@me': username}.get(args.quota, args.quota), 'below': args.below, 'above': args.above, 'fields': args.fields}
+    quota({k: v for k, v in params.items() if v is not None}, args.format, args.watch)
@@ -3,27 +3,46 @@
 # Create Time: 2021/09/23 
 
 import os
+import sys
+import fcntl
+import atexit
 import logging
 from re import compile as Regex
-from json import loads
+from json import loads, dumps
+from hashlib import md5, sha256
+import hmac
+from uuid import uuid4
 from shutil import copy
-from time import time
-from threading import Timer, RLock
-from datetime import datetime
+from time import monotonic, sleep
+from threading import Timer, Thread, Event, Condition, Lock, RLock, get_ident
+from concurrent.futures import ThreadPoolExecutor, wait
+from datetime import datetime, timedelta
 from base64 import b64decode
-from random import sample, shuffle
-from collections import defaultdict, deque
-from typing import DefaultDict, Union, Tuple
+from random import Random, sample
+from itertools import combinations
+from math import comb, isfinite, inf
+from bisect import bisect_left, insort
+from heapq import heappush, heappop
+from collections import defaultdict, OrderedDict
+from typing import DefaultDict, Union, Tuple, Callable
+from functools import wraps
+from importlib import import_module
+from urllib.request import Request, urlopen
+from urllib.error import HTTPError
 from traceback import format_exc
 from pwd import getpwuid
 
-from flask import Flask, jsonify, request, render_template
+from flask import Flask, Response, jsonify, request, render_template
 from flask_cors import CORS
+from werkzeug.serving import make_server
+import numpy as np
 import paramiko
 from paramiko.client import SSHClient
 from paramiko.ssh_exception import AuthenticationException, SSHException
 
 from settings import *
+if os.environ.get('SODAYO_SETTINGS'):   # NOTE: pick another settings module, eg. for several instances on one machine
+  globals().update({k: v for k, v in vars(import_module(os.environ['SODAYO_SETTINGS'])).items() if not k.startswith('_')})
 
 
 __version__ = '0.1'     # 2021/09/27
@@ -39,11 +58,17 @@ app = Flask(__name__, template_folder='', static_folder='')
 CORS(app, support_credential=True, resources={r'/*': {'origins': '*'}})
 
 host_resolv = { }           # {'hostname': sock(hist:str, port:int)}, for ssh to kill
-gpu_runtime = defaultdict(lambda:defaultdict(set))    # {'hostname': {0: {'username'}}}
+gpu_runtime = None          # Occupancy, like {'hostname': {0: {'username'}}}, see `Occupancy`
+gpu_stats   = defaultdict(dict)   # {'hostname': {0: {'memory.used': int, 'memory.total': int, 'utilization.gpu': int}}}
+gpu_topology = { }          # {'hostname': {(gpu_i, gpu_j): link_score(int)}}, by `nvidia-smi topo -m`
+published   = { }           # {'runtime'|'quota'|'stats'|'quota_detail': Snapshot}, read-only views for HTTP readers
+published_cond = Condition()  # notified whenever `published` changes, for long-poll & SSE readers
+sse_streams = 0             # `/events` streams open in this process, each holding a server thread, see SSE_MAX_STREAMS
+sse_lock    = Lock()        # guards `sse_streams`
 
 logger = None
-monitor = None
-lock = RLock()              # global lock, may be useful in cases ...
+monitor = None              # only in the leader (or standalone) process, see `create_app()`
+serving_role = None         # 'standalone' | 'leader' | 'follower'
 
 
 ##############################################################################
@@ -78,38 +103,320 @@ class RESPONSE:
     if reason is not None: r['reason'] = reason
     return jsonify(r)
 
+  def cached(snap:'Snapshot') -> Response:
+    r = app.response_class(snap.body, mimetype='application/json')
+    r.set_etag(snap.etag)
+    return r.make_conditional(request)    # 304 if `If-None-Match` hits
+
   ok = lambda data=None: RESPONSE.make(ok=True, data=data)
   fail = lambda reason=None: RESPONSE.make(ok=False, reason=reason)
 
 min_to_sec  = lambda x: x * 60
 min_to_hour = lambda x: x / 60
+sec_to_hour = lambda x: x / 3600
 now_ts = lambda: datetime.timestamp(datetime.now())
 
 sock_to_hostport = lambda sock: f'{sock[0]}:{sock[1]}'
 
-def to_serializable(data):
-  if data is None:
-    return None
-  elif type(data) in [int, float, str]:
-    return data
-  elif type(data) in [list, tuple, set, deque]:
-    return [to_serializable(v) for v in data]
-  elif type(data) in [dict, defaultdict]:
-    return {to_serializable(k): to_serializable(v) for k, v in data.items()}
-  else:
-    return repr(data)
+ANSI_REGEX = Regex(r'\x1b\[[0-9;]*m')
+TOPO_GPU_REGEX = Regex(r'^GPU(\d+)$')    # NOTE: not 'GPU NUMA ID' in the header by recent drivers
+TOPO_RETRY = (60, 3600)   # seconds, backoff range of retrying a failed topology query
+TOPO_LINK_SCORE = {'SYS': 1, 'NODE': 2, 'PHB': 3, 'PXB': 4, 'PIX': 5}    # the closer the higher, 'NV#' scores 5 + #
+
+def parse_topology(text:str) -> dict:
+  ''' parse the matrix by `nvidia-smi topo -m` into {(gpu_i, gpu_j): link_score} '''
+
+  lines = [ANSI_REGEX.sub('', line) for line in text.split('\n') if line.strip()]
+  if not lines: return { }
+  gpu_cols = [int(m.group(1)) for col in lines[0].split() if (m := TOPO_GPU_REGEX.match(col))]
+
+  topo = { }
+  for line in lines[1:]:
+    row = line.split()
+    m = TOPO_GPU_REGEX.match(row[0])
+    if not m: continue     # NIC rows & legends
+    i = int(m.group(1))
+    for j, link in zip(gpu_cols, row[1:]):
+      if link == 'X': continue
+      topo[(i, j)] = link.startswith('NV') and 5 + int(link[2:]) or TOPO_LINK_SCORE.get(link, 0)
+  return topo
+
+def new_timer(interval:float, fn) -> Timer:
+  # NOTE: daemon, so that a process exits without waiting timers, states are saved by `atexit` hooks
+  timer = Timer(interval, fn)
+  timer.daemon = True
+  return timer
+
+def http_call(url:str, data:dict=None, timeout:float=SSH_TIMEOUT) -> dict:
+  # JSON over HTTP among sodayo instances, returns `data` of a `RESPONSE.ok()`, or raises
+  headers = {'Content-Type': 'application/json', 'X-Shard-Secret': SHARD_SECRET or ''}
+  req = Request(url, data=data is not None and dumps(data).encode() or None, headers=headers, method=data is None and 'GET' or 'POST')
+  with urlopen(req, timeout=timeout) as resp:
+    r = loads(resp.read())
+  if not r['ok']: raise RuntimeError(r['reason'])
+  return r.get('data')
+
+def pad_to(a:np.ndarray, n:int) -> np.ndarray:
+  # zero-pad the last axis to length `n`, eg. a vector or matrix by user id, to one interned with more users
+  if a.shape[-1] >= n: return a
+  return np.pad(a, [(0, 0)] * (a.ndim - 1) + [(0, n - a.shape[-1])])
+
+class Snapshot:
+
+  def __init__(self, data, version:int=1, **extra):
+    self.data    = data     # JSON-serializable, NEVER mutate once published
+    self.extra   = extra    # more fields along with 'data', eg. 'stale'
+    self.body    = dumps({'ok': True, 'data': data, **extra}, sort_keys=True).encode()    # the `RESPONSE.ok(data)` body
+    self.etag    = md5(self.body).hexdigest()
+    self.version = version
+    self.ts      = now_ts()
+
+def publish_snapshot(name:str, data, **extra) -> Snapshot:
+  # writers build a new one and swap the reference, so readers pick `published[name]` up without lock
+  # NOTE: writers should serialize on `publish_lock`
+  old = published.get(name)
+  snap = Snapshot(data, old and old.version + 1 or 1, **extra)
+  if old and old.etag == snap.etag: return old      # nothing changed, keep the version
+  published[name] = snap
+  with published_cond: published_cond.notify_all()
+  if serving_role == 'leader': save_snapshot(name, snap)
+  return snap
+
+def save_snapshot(name:str, snap:Snapshot):
+  # for followers to mirror, see `follow()`
+  fp = os.path.join(BASE_PATH, STATE_PATH, f'{name}.json')
+  with open(fp + '.tmp', 'wb') as fh:
+    fh.write(snap.body)
+  os.replace(fp + '.tmp', fp)
+
+def wait_published(pred, timeout:float) -> bool:
+  # block until `pred()` holds on `published`, or timeout
+  with published_cond:
+    return published_cond.wait_for(pred, timeout)
+
+RUNTIME_FIELDS = ['users', 'memory.used', 'memory.total', 'utilization.gpu']
+QUOTA_FIELDS   = ['remnant', 'allotment', 'used', 'priority']
+
+def split_arg(args:dict, name:str, choices:list=None) -> set:
+  # comma-separated values of a query arg, eg. `?user=a,b`, None if not given
+  if not args.get(name): return None
+  values = {v for v in args[name].split(',') if v}
+  if choices and not values <= set(choices): raise ValueError(f'{name} not in {choices}')
+  return values
+
+def number_arg(args:dict, name:str, type=float):
+  # None if not given
+  if args.get(name) in [None, '']: return None
+  return type(args[name])
+
+def runtime_view(args:dict) -> Tuple[list, Callable]:
+  ''' filter `/runtime` by ?host, ?user, ?min_free, ?max_util, ?max_mem, select ?fields of each card
+      returns the snapshot names it reads, and a fn to build the view, NOTE: raise ValueError on bad args '''
+
+  hosts, users = split_arg(args, 'host'), split_arg(args, 'user')
+  fields = split_arg(args, 'fields', RUNTIME_FIELDS)
+  min_free = number_arg(args, 'min_free', int)     # hosts with at least such many cards without process
+  max_util = number_arg(args, 'max_util')          # cards with `utilization.gpu` (%) not above
+  max_mem  = number_arg(args, 'max_mem')           # cards with `memory.used` (MiB) not above
+  with_stats = bool(max_util is not None or max_mem is not None or (fields and fields - {'users'}))
+  by_card = bool(users or with_stats)
+
+  def build() -> Snapshot:
+    snap = published['runtime']
+    stats = with_stats and published['stats'].data or { }
+    runtime = { }
+    for hostname, gpu_rt in snap.data.items():
+      if hosts and hostname not in hosts: continue
+      if min_free is not None and sum(not card_users for card_users in gpu_rt.values()) < min_free: continue
+      gpu_stat = stats.get(hostname, { })
+      cards = { }
+      for gpu_id, card_users in gpu_rt.items():
+        stat = gpu_stat.get(gpu_id, { })
+        if users and users.isdisjoint(card_users): continue
+        if max_util is not None and stat.get('utilization.gpu', 0) > max_util: continue
+        if max_mem is not None and stat.get('memory.used', 0) > max_mem: continue
+        cards[gpu_id] = fields and {f: card_users if f == 'users' else stat.get(f) for f in sorted(fields)} or card_users
+      if cards or not by_card: runtime[hostname] = cards
+    stale = {k: v for k, v in snap.extra.get('stale', { }).items() if k in runtime}
+    return Snapshot(runtime, snap.version, **(stale and {'stale': stale} or { }))
+
+  return ['runtime'] + (with_stats and ['stats'] or [ ]), build
+
+def quota_view(args:dict) -> Tuple[list, Callable]:
+  ''' filter `/quota` by ?username, ?below, ?above (hours of remnant), select ?fields of each user
+      returns the snapshot names it reads, and a fn to build the view, NOTE: raise ValueError on bad args '''
+
+  usernames = split_arg(args, 'username')
+  fields = split_arg(args, 'fields', QUOTA_FIELDS)
+  below = number_arg(args, 'below')
+  above = number_arg(args, 'above')
+
+  def build() -> Snapshot:
+    snap = published['quota']
+    detail = fields and published['quota_detail'].data or { }
+    quotas = { }
+    for username, remnant in snap.data.items():
+      if usernames and username not in usernames: continue
+      if below is not None and remnant >= below: continue
+      if above is not None and remnant <= above: continue
+      quotas[username] = fields and {f: detail.get(username, { }).get(f) for f in sorted(fields)} or remnant
+    return Snapshot(quotas, snap.version)
+
+  return ['quota'] + (fields and ['quota_detail'] or [ ]), build
+
+
+##############################################################################
+# metrics
+
+all_metrics = [ ]           # [Counter|Gauge|Histogram], exported by `/metrics` in Prometheus text format
+
+def render_labels(names:tuple, values:tuple, **extra) -> str:
+  escape = lambda v: str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+  pairs = [f'{k}="{escape(v)}"' for k, v in list(zip(names, values)) + list(extra.items())]
+  return pairs and '{' + ','.join(pairs) + '}' or ''
+
+def render_metrics() -> str:
+  lines = [ ]
+  for metric in all_metrics:
+    lines.append(f'# HELP {metric.name} {metric.help}')
+    lines.append(f'# TYPE {metric.name} {metric.TYPE}')
+    lines.extend(metric.render())
+  return '\n'.join(lines) + '\n'
+
+class Counter:
+
+  TYPE = 'counter'
+
+  def __init__(self, name:str, help:str, labels:tuple=()):
+    self.name, self.help, self.labels = name, help, labels
+    self.values = defaultdict(float)    # {label_values: float}
+    self.lock = Lock()
+    all_metrics.append(self)
+
+  def inc(self, *label_values, n:float=1):
+    with self.lock: self.values[label_values] += n
+
+  def render(self) -> list:
+    with self.lock: values = list(self.values.items())
+    return [f'{self.name}{render_labels(self.labels, k)} {v}' for k, v in values]
+
+class Gauge:
+
+  TYPE = 'gauge'
+
+  def __init__(self, name:str, help:str, labels:tuple=(), fn=None):
+    # NOTE: collected on scrape by `fn() -> {label_values: float}`, rather than being set on each change
+    self.name, self.help, self.labels, self.fn = name, help, labels, fn
+    all_metrics.append(self)
+
+  def render(self) -> list:
+    try: values = self.fn().items()
+    except Exception as e:    # eg. monitor not started
+      logger.debug(f'[metrics] gauge {self.name!r} failed: {e!r}')
+      return [ ]
+    return [f'{self.name}{render_labels(self.labels, k)} {v}' for k, v in values]
+
+class Histogram:
+
+  TYPE = 'histogram'
+  BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+  def __init__(self, name:str, help:str, labels:tuple=(), buckets:tuple=BUCKETS):
+    self.name, self.help, self.labels, self.buckets = name, help, labels, buckets
+    self.values = { }     # {label_values: [cnt_of_each_bucket (not cumulative), cnt_beyond, sum, cnt]}
+    self.lock = Lock()
+    all_metrics.append(self)
+
+  def observe(self, value:float, *label_values):
+    i = bisect_left(self.buckets, value)    # the first bucket with `value <= le`
+    with self.lock:
+      v = self.values.get(label_values) or self.values.setdefault(label_values, [0] * (len(self.buckets) + 3))
+      v[i] += 1
+      v[-2] += value
+      v[-1] += 1
+
+  def render(self) -> list:
+    with self.lock: values = [(k, list(v)) for k, v in self.values.items()]
+    lines = [ ]
+    for k, v in values:
+      cnt = 0
+      for le, n in zip(self.buckets + ('+Inf',), v):
+        cnt += n
+        lines.append(f'{self.name}_bucket{render_labels(self.labels, k, le=le)} {cnt}')
+      lines.append(f'{self.name}_sum{render_labels(self.labels, k)} {v[-2]}')
+      lines.append(f'{self.name}_count{render_labels(self.labels, k)} {v[-1]}')
+    return lines
+
+SSH_QUERY_SECONDS = Histogram('sodayo_ssh_query_seconds', 'Latency of querying a host', ('host',))
+SYNC_SECONDS      = Histogram('sodayo_sync_seconds', 'Duration of a sync over all hosts')
+REALLOC_SECONDS   = Histogram('sodayo_realloc_seconds', 'Latency of a realloc job from submit to finish', ('state',),
+                              buckets=(0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900, 1800, 3600))
+LOCK_WAIT_SECONDS = Histogram('sodayo_lock_wait_seconds', 'Time waited to acquire a lock', ('lock',),
+                              buckets=(0.0001, 0.001, 0.01, 0.1, 0.5, 1, 5, 10))
+KILLED_PROCESSES  = Counter('sodayo_killed_processes_total', 'Processes signaled by preemption', ('host', 'result'))
+
+class Profiler:
+
+  ''' sampling profiler over all threads, counting stacks (frames of this file only) in the collapsed format of flamegraph '''
+
+  def __init__(self):
+    self.samples = defaultdict(int)   # {'fn_outer;fn_inner': cnt}
+    self.thread  = None
+    self.stop_ts = 0
+    self.lock    = Lock()
+
+  @property
+  def running(self) -> bool:
+    return self.thread is not None and self.thread.is_alive()
+
+  def start(self, seconds:float):
+    # NOTE: starting a running one just extends it, with samples kept
+    self.stop_ts = monotonic() + seconds
+    with self.lock:
+      if self.running: return
+      self.samples.clear()
+      self.thread = Thread(target=self._run, name='profiler', daemon=True)
+      self.thread.start()
+
+  def stop(self):
+    self.stop_ts = 0
+
+  def _run(self):
+    me = get_ident()
+    while monotonic() < self.stop_ts:
+      for tid, frame in sys._current_frames().items():
+        if tid == me: continue
+        stack = [ ]
+        while frame:
+          code = frame.f_code
+          if code.co_filename == __file__ and code.co_name != 'wrapper':    # NOTE: decorators are just noise
+            stack.append(code.co_name)
+          frame = frame.f_back
+        if stack:
+          with self.lock: self.samples[';'.join(reversed(stack))] += 1
+      sleep(PROFILER_INTERVAL)
+
+  def dump(self) -> str:
+    with self.lock: samples = sorted(self.samples.items(), key=lambda x: -x[1])
+    return ''.join(f'{stack} {cnt}\n' for stack, cnt in samples)
+
+profiler = Profiler()
 
 
 ##############################################################################
 # workers
 
-def perf_counter(fn):
-  def wrapper(self, *args, **kwargs):
-    start = time()
-    r = fn(self, *args, **kwargs)
-    end = time()
-    logger.debug(f'[perf_counter]: {fn.__name__} {end - start:.4f}s')
-    return r
+def perf_counter(hist:Histogram):
+  def wrapper(fn):
+    def wrapper(self, *args, **kwargs):
+      start = monotonic()
+      try:
+        return fn(self, *args, **kwargs)
+      finally:
+        elapsed = monotonic() - start
+        hist.observe(elapsed)
+        logger.debug(f'[perf_counter]: {fn.__name__} {elapsed:.4f}s')
+    return wrapper
   return wrapper
 
 def check_rotate(fn):
@@ -119,29 +426,115 @@ def check_rotate(fn):
     return fn(self, *args, **kwargs)
   return wrapper
 
-def with_lock(lock:RLock):
+class LockTimeout(Exception): pass
+
+class TimedLock:
+
+  def __init__(self, name:str):
+    self.name = name
+    self.lock = RLock()
+    self.depth = 0            # reentrant depth, only touched by the owner thread
+    self.hold_start = None
+    # stats, of the outermost acquire/release
+    self.acquires = 0
+    self.timeouts = 0
+    self.wait_sum = 0.0
+    self.wait_max = 0.0
+    self.hold_sum = 0.0
+    self.hold_max = 0.0
+
+  def acquire(self, timeout:float=None) -> bool:
+    start = monotonic()
+    if not self.lock.acquire(timeout=LOCK_TIMEOUT if timeout is None else timeout):
+      self.timeouts += 1
+      return False
+
+    self.depth += 1
+    if self.depth == 1:
+      wait = monotonic() - start
+      LOCK_WAIT_SECONDS.observe(wait, self.name)
+      self.acquires += 1
+      self.wait_sum += wait
+      self.wait_max = max(self.wait_max, wait)
+      self.hold_start = monotonic()
+    return True
+
+  def release(self):
+    self.depth -= 1
+    if self.depth == 0:
+      hold = monotonic() - self.hold_start
+      self.hold_sum += hold
+      self.hold_max = max(self.hold_max, hold)
+    self.lock.release()
+
+  def __enter__(self):
+    if not self.acquire():
+      logger.error(f'[TimedLock] {self.name!r} not acquired in {LOCK_TIMEOUT}s')
+      raise LockTimeout(f'lock {self.name!r} timeout')
+    return self
+
+  def __exit__(self, *exc):
+    self.release()
+
+  def stats(self) -> dict:
+    return {
+      'acquires': self.acquires,
+      'timeouts': self.timeouts,
+      'wait_avg': self.acquires and self.wait_sum / self.acquires,
+      'wait_max': self.wait_max,
+      'hold_avg': self.acquires and self.hold_sum / self.acquires,
+      'hold_max': self.hold_max,
+    }
+
+def with_lock(lock:TimedLock):
   def wrapper(fn):
     def wrapper(self, *args, **kwargs):
-      lock.acquire()
-      r = fn(self, *args, **kwargs)
-      lock.release()
-      return r
+      with lock:
+        return fn(self, *args, **kwargs)
     return wrapper
   return wrapper
 
+quota_lock   = TimedLock('quota')     # `QuotaTracker` states
+index_lock   = TimedLock('index')     # `AllocIndex` states, including reservations
+publish_lock = TimedLock('publish')   # serialize writers of `published`
+host_locks   = { }                    # {'hostname': TimedLock}, per-host states in `gpu_runtime`, `gpu_stats` & `UsageAccountant`
+
+def host_lock(hostname:str) -> TimedLock:
+  # NOTE: `setdefault()` is atomic, a redundant one created in a race is just dropped
+  return host_locks.get(hostname) or host_locks.setdefault(hostname, TimedLock(f'host:{hostname}'))
+
+def lock_stats() -> dict:
+  locks = [quota_lock, index_lock, publish_lock] + list(host_locks.values())
+  return {lock.name: lock.stats() for lock in locks}
+
 class QuotaTracker:
 
   WHITESPACE_REGEX = Regex(r'\s+')
+  JOURNAL_SEQ_REGEX = Regex(r'^#\s*journal_seq\s+(\d+)')
+  ALLOTMENT_REGEX = Regex(r'^#\s*allotment\s+(\S+)\s+(\S+)')
+  SHARD_SEQ_REGEX = Regex(r'^#\s*shard_seq\s+(\S+)\s+(\S+)\s+(\d+)')
+  REMOVED_REGEX = Regex(r'^#\s*removed\s+(\S+)\s+(\S+)')
 
   quota_info = { }    # 'username': time_remnants(float)
   
   def _get_fp(self) -> str:
     return os.path.join(BASE_PATH, DATA_PATH, f'quota_{datetime.now().strftime("%Y-%m")}.txt')
 
+  def _get_journal_fp(self) -> str:
+    return os.path.splitext(self.current_fp)[0] + '.journal'
+
   def __init__(self):
     # the file (abspath) that associated with current `quota_info`
     self.current_fp = None
-    self.dump_timer = Timer(min_to_sec(DUMP_INTERVAL // 2), self.dump_task)
+    # append-only journal of dequota events since last dump of `current_fp`, as lines of '<seq> <ts> <username> <delta>'
+    self.journal = None
+    self.seq     = 0      # seq of the latest journaled event
+    self.pending = 0      # count of journaled events not fsynced yet
+    self.generation = 0   # bumped on each `load()`, so that derived states know to rebuild
+    self.allotment = { }  # 'username': quota_hours_per_month(float), the rules in QUOTA_INIT_FILE applied to `quota_info`
+    self.acked = { }      # {('shard_url', 'epoch'): seq}, of the last usage batch applied from each shard, see `GpuMonitor.absorb()`
+    self.removed = { }    # 'username': used_hours(float), of those removed from the rules this month, restored if added back
+    self.dump_timer = new_timer(min_to_sec(DUMP_INTERVAL // 2), self.dump_task)
   
   def start(self):
     self.rotate()
@@ -150,73 +543,280 @@ class QuotaTracker:
   def stop(self):
     self.dump_timer.cancel()
     self.dump()
-
-  def load(self):
-    logger.info(f'[load] from {self.current_fp}')
-
-    with open(self.current_fp, 'r', encoding='utf8') as fh:
+    self.journal.close()
+
+  @classmethod
+  def parse(cls, fp:str, quota_info:dict, allotment:dict=None, acked:dict=None, removed:dict=None) -> int:
+    # parse lines of '<username> <quota>' into `quota_info`, and the allotment, shard seqs & removed users tagged if any
+    # into `allotment`, `acked` & `removed`, return the journal seq tagged if any
+    seq = 0
+    with open(fp, 'r', encoding='utf8') as fh:
       for line in fh.read().split('\n'):
+        m = cls.JOURNAL_SEQ_REGEX.match(line)
+        if m: seq = int(m.group(1))
+        m = allotment is not None and cls.ALLOTMENT_REGEX.match(line)
+        if m: allotment[m.group(1)] = float(m.group(2))
+        m = acked is not None and cls.SHARD_SEQ_REGEX.match(line)
+        if m: acked[(m.group(1), m.group(2))] = int(m.group(3))
+        m = removed is not None and cls.REMOVED_REGEX.match(line)
+        if m: removed[m.group(1)] = float(m.group(2))
         if line.startswith('#') or not line.strip(): continue
         try:
-          username, quota = self.WHITESPACE_REGEX.sub(' ', line.strip()).split(' ')
-          self.quota_info[username] = float(quota)
+          username, quota = cls.WHITESPACE_REGEX.sub(' ', line.strip()).split(' ')
+          quota_info[username] = float(quota)
         except:
           logger.warning(f' << cannot parse line {line!r}, ignored')
-  
-  def dump(self):
+    return seq
+
+  def load(self):
+    logger.info(f'[load] from {self.current_fp}')
+
+    self.quota_info.clear()
+    self.allotment.clear()
+    self.removed.clear()
+    self.seq = self.parse(self.current_fp, self.quota_info, self.allotment, self.acked, self.removed)    # NOTE: acked ones carry over months
+    if not self.allotment:    # a new month copied from the rules, or dumped before allotments were tagged
+      self.parse(os.path.join(BASE_PATH, QUOTA_INIT_FILE), self.allotment)
+
+    # replay events journaled after the snapshot was dumped
+    journal_fp = self._get_journal_fp()
+    if os.path.exists(journal_fp):
+      cnt = 0
+      with open(journal_fp, 'r', encoding='utf8') as fh:
+        for line in fh:
+          try:
+            seq, ts, username, delta = line.split(' ')
+            if username == '@shard':    # a usage batch from a shard applied, see `ack()`
+              shard, epoch, delta = delta.split(',')
+              seq, delta = int(seq), int(delta)
+            else:
+              seq, delta = int(seq), float(delta)
+          except:
+            logger.warning(f' << cannot parse journal line {line!r}, ignored')   # NOTE: may be torn by a crash
+            continue
+          if seq <= self.seq: continue    # already in the snapshot
+          if username == '@shard': self._set_acked(shard, epoch, delta)
+          elif username in self.quota_info: self.quota_info[username] += delta
+          self.seq = seq
+          cnt += 1
+      logger.info(f'[load] replayed {cnt} event(s) from {journal_fp}')
+
+    self.journal = open(journal_fp, 'a', encoding='utf8')
+    self.pending = 0
+    # the rules may have been modified while we were down
+    self.apply_rules()
+    self.generation += 1
+
+  @with_lock(quota_lock)
+  def commit(self):
+    # fsync journaled events in a batch, NOTE: call after each round of dequota
+    if not self.pending: return
+
+    self.journal.flush()
+    os.fsync(self.journal.fileno())
+    self.pending = 0
+
+  @with_lock(quota_lock)
+  def dump(self, quota_info:dict=None):
+    # compaction: write a full snapshot tagged with the journal seq, then the journal can be truncated
+    # a given quota_info is written instead, and swapped in only once it is on disk
     logger.info(f'[dump] to {self.current_fp}')
 
-    with open(self.current_fp, 'w', encoding='utf8') as fh:
-      for username, quota in self.quota_info.items():
+    tmp_fp = self.current_fp + '.tmp'
+    with open(tmp_fp, 'w', encoding='utf8') as fh:
+      fh.write(f'# journal_seq {self.seq}\n')
+      for username, quota in self.allotment.items():
+        fh.write(f'# allotment {username} {quota}\n')
+      for (shard, epoch), seq in self.acked.items():
+        fh.write(f'# shard_seq {shard} {epoch} {seq}\n')
+      for username, used in self.removed.items():
+        fh.write(f'# removed {username} {used:.4f}\n')
+      for username, quota in (quota_info or self.quota_info).items():
         fh.write(f'{username} {quota:.4f}\n')
+      fh.flush()
+      os.fsync(fh.fileno())
+    os.replace(tmp_fp, self.current_fp)
+    if quota_info: self.quota_info.update(quota_info)
+
+    # NOTE: crash right here is fine, the events would be skipped by seq on replay
+    self.journal.truncate(0)
+    os.fsync(self.journal.fileno())
+    self.pending = 0
   
-  @with_lock(lock)
+  @with_lock(quota_lock)
   def rotate(self):
     logger.info('[rotate]')
 
     # if current `quota_info` is already associated, dump to that file
-    if self.current_fp: self.dump()
+    if self.current_fp:
+      self.dump()
+      self.journal.close()
 
     # rotate to new file
     self.current_fp = self._get_fp()
     # absence indicates a new month beginning, let's make a new copy from `quota_init`
-    if not os.path.exists(self.current_fp):
+    fresh = not os.path.exists(self.current_fp)
+    if fresh:
       os.makedirs(os.path.join(BASE_PATH, DATA_PATH), exist_ok=True)
       copy(os.path.join(BASE_PATH, QUOTA_INIT_FILE), self.current_fp)
       
     # load `quota_info` from file
     self.load()
+    if fresh and self.acked: self.dump()    # carry the shard seqs over
 
   @check_rotate
   def dequota(self, username:str, time_in_hour:float):
     if username in self.quota_info:
       logger.info(f'  >> user {username!r} of {time_in_hour:.4f} hour(s)')
       self.quota_info[username] -= time_in_hour
+      self.seq += 1
+      self.journal.write(f'{self.seq} {now_ts():.3f} {username} {-time_in_hour:.6f}\n')
+      self.pending += 1
     else:
       logger.warning(f'  << user {username!r} is beyond track, ignored')
 
+  def _set_acked(self, shard:str, epoch:str, seq:int):
+    # NOTE: batches of an earlier epoch would never be resent, since the shard restarted
+    for key in [k for k in self.acked if k[0] == shard and k[1] != epoch]: del self.acked[key]
+    self.acked[(shard, epoch)] = max(self.acked.get((shard, epoch), 0), seq)
+
+  @check_rotate
+  def ack(self, shard:str, epoch:str, seq:int):
+    # usage batches from the shard till `seq` are applied, journaled so as to be applied once across restarts,
+    # NOTE: call after the dequota of these batches, before `commit()`
+    self._set_acked(shard, epoch, seq)
+    self.seq += 1
+    self.journal.write(f'{self.seq} {now_ts():.3f} @shard {shard},{epoch},{seq}\n')
+    self.pending += 1
+
   @check_rotate
   def query(self) -> dict:
     return self.quota_info        # NOTE: use `.copy()` if security signifies
 
+  @with_lock(quota_lock)
+  @check_rotate
+  def reload(self) -> dict:
+    ''' re-read QUOTA_INIT_FILE and apply the changed rules to `quota_info`, returns the diff {'added', 'removed', 'changed'} '''
+
+    logger.info('[reload]')
+    return self.apply_rules()
+
+  def apply_rules(self) -> dict:
+    # diff QUOTA_INIT_FILE against the allotment applied, NOTE: call with `quota_lock` held
+    allotment = { }
+    self.parse(os.path.join(BASE_PATH, QUOTA_INIT_FILE), allotment)
+    if not allotment and self.allotment:
+      # NOTE: most likely caught in the middle of a write, rather than everyone removed on purpose
+      logger.warning(f'  << no rule in {QUOTA_INIT_FILE!r}, ignored')
+      return {'added': { }, 'removed': [ ], 'changed': { }}
+    added   = {u: q for u, q in allotment.items() if u not in self.allotment}
+    removed = [u for u in self.allotment if u not in allotment]
+    changed = {u: q - self.allotment[u] for u, q in allotment.items() if u in self.allotment and q != self.allotment[u]}
+
+    # a new user starts with a full allotment as if the month begins, a changed one keeps what has been used,
+    # so does a removed one when added back in the same month
+    for username, quota in added.items():
+      self.quota_info.setdefault(username, quota - self.removed.pop(username, 0))
+    for username in removed:
+      if username in self.quota_info: self.removed[username] = self.allotment[username] - self.quota_info.pop(username)
+    for username, delta in changed.items():
+      if username in self.quota_info: self.quota_info[username] += delta
+    self.allotment.clear()
+    self.allotment.update(allotment)
+
+    if added or removed or changed:
+      logger.info(f'  >> added {list(added)}, removed {removed}, changed {list(changed)}')
+      self.dump()
+    return {'added': added, 'removed': removed, 'changed': changed}
+
+  @with_lock(quota_lock)
+  @check_rotate
+  def adjust(self, deltas:dict) -> dict:
+    ''' grant (positive) or debit (negative) hours to many users, all or none, returns their remnants '''
+
+    unknown = [u for u in deltas if u not in self.quota_info]
+    if unknown: raise KeyError(f'username {", ".join(map(repr, unknown))} not found')
+
+    quota_info = dict(self.quota_info)
+    for username, delta in deltas.items():
+      quota_info[username] += delta
+    # NOTE: one atomic write of the full snapshot, rather than journal lines that a crash may leave half applied
+    self.dump(quota_info)
+    return {u: self.quota_info[u] for u in deltas}
+
   def dump_task(self):
     # reset timer
-    self.dump_timer = Timer(min_to_sec(DUMP_INTERVAL), self.dump_task)
+    self.dump_timer = new_timer(min_to_sec(DUMP_INTERVAL), self.dump_task)
     self.dump_timer.start()
 
     # do work
     self.dump()
 
+class HostHealth:
+
+  def __init__(self):
+    self.connects = 0             # successful connects in total
+    self.failures = 0             # failed connects & broken connections in total
+    self.consecutive_failures = 0 # reset on a successful connect, drives the backoff
+    self.last_ok_ts = None
+    self.last_fail_ts = None
+    self.last_error = None
+    self.connect_time = None      # seconds cost by the last successful connect
+    self.next_probe_ts = 0        # circuit open (skip this host) until then
+
+  @property
+  def backoff(self) -> float:
+    if not self.consecutive_failures: return 0
+    return min(SSH_BACKOFF_BASE * 2 ** (self.consecutive_failures - 1), SSH_BACKOFF_MAX)
+
+  @property
+  def state(self) -> str:
+    if not self.consecutive_failures: return 'up'
+    return now_ts() < self.next_probe_ts and 'down' or 'probing'
+
+  def ok(self, connect_time:float):
+    self.connects += 1
+    self.consecutive_failures = 0
+    self.last_ok_ts = now_ts()
+    self.connect_time = connect_time
+    self.next_probe_ts = 0
+
+  def fail(self, error:str):
+    self.failures += 1
+    self.consecutive_failures += 1
+    self.last_fail_ts = now_ts()
+    self.last_error = error
+    self.next_probe_ts = self.last_fail_ts + self.backoff
+
+  def to_dict(self) -> dict:
+    r = {k: v for k, v in vars(self).items()}
+    r['state'] = self.state
+    r['backoff'] = self.backoff
+    return r
+
 class SshPool:
 
   SYSTEM_USERNAME = getpwuid(os.getuid()).pw_name
-  SYSTEM_PKEY = paramiko.RSAKey.from_private_key_file(os.path.join(os.path.expanduser('~'), '.ssh/id_rsa'))
+  system_pkey = None    # NOTE: loaded on the first connect, so that import & startup never wait on (or fail by) the key file
+
+  @classmethod
+  def get_pkey(cls) -> paramiko.RSAKey:
+    if cls.system_pkey is None:
+      cls.system_pkey = paramiko.RSAKey.from_private_key_file(os.path.join(os.path.expanduser('~'), '.ssh/id_rsa'))
+    return cls.system_pkey
 
   def __init__(self):
-    self.pool = { }         # { sock(str,int): SSHClient }
-  
+    self.pool   = { }                     # { sock(str,int): SSHClient }
+    self.health = defaultdict(HostHealth) # { sock(str,int): HostHealth }
+    self.locks  = defaultdict(Lock)       # { sock(str,int): Lock }, one connecting attempt per host at a time
+    self.probe_timer = new_timer(min(SSH_PROBE_INTERVAL, SSH_BACKOFF_BASE), self.probe_task)
+
+  def start(self):
+    self.probe_timer.start()
+
   def destroy(self):
-    for ssh in self.pool.values():
+    self.probe_timer.cancel()
+    for ssh in list(self.pool.values()):
       ssh.close()
     self.pool.clear()
 
@@ -229,7 +829,6 @@ class SshPool:
     return ssh
   
   @staticmethod
-  @with_lock(lock)
   def test_login(sock, username, password) -> bool:
     logger.info('[SshPool.test_login]')
 
@@ -249,60 +848,1482 @@ class SshPool:
       ssh.close()
 
   def get(self, sock:Tuple[str, int]) -> SSHClient:
-    if sock not in self.pool:
+    if sock in self.pool: return self.pool[sock]
+
+    # circuit breaker: known-down host is skipped until its next probe window
+    health = self.health[sock]
+    if health.state == 'down': return None
+
+    with self.locks[sock]:
+      if sock in self.pool: return self.pool[sock]    # connected by another thread meanwhile
+
       host, port = sock
+      start = now_ts()
+      ssh = SshPool.new()
       try:
-        ssh = SshPool.new()
-        ssh.connect(hostname=host, port=port, username=self.SYSTEM_USERNAME, pkey=self.SYSTEM_PKEY,
-                    banner_timeout=SSH_TIMEOUT)
-        sh_cmd = 'hostname'   # just for a test
-        stdin, stdout, stderr = ssh.exec_command(sh_cmd, timeout=SSH_TIMEOUT)
-        _ = stdout.read().strip()
-      except:
-        pass
+        ssh.connect(hostname=host, port=port, username=self.SYSTEM_USERNAME, pkey=self.get_pkey(),
+                    timeout=SSH_TIMEOUT, banner_timeout=SSH_TIMEOUT)
+        ssh.get_transport().set_keepalive(SSH_KEEPALIVE)
+      except Exception as e:
+        ssh.close()
+        health.fail(repr(e))
+        logger.warning(f'[SshPool.get] connect {sock_to_hostport(sock)} failed: {e!r}, retry in {health.backoff}s')
       else:
+        health.ok(now_ts() - start)
         self.pool[sock] = ssh
 
     return self.pool.get(sock)
 
-  def mark_broken(self, ssh:SSHClient):
-    logger.info('[SshPool.mark_broken]')
+  def mark_broken(self, sock:Tuple[str, int], error:str='broken'):
+    logger.info(f'[SshPool.mark_broken] {sock_to_hostport(sock)}')
 
-    for k, v in self.pool.items():
-      if ssh == v:
-        ssh.close()
-        self.pool.pop(k)
-        break
+    ssh = self.pool.pop(sock, None)
+    if ssh is None: return
+    ssh.close()
+    self.health[sock].fail(error)
+
+  def stats(self) -> dict:
+    return {sock_to_hostport(sock): health.to_dict() for sock, health in list(self.health.items())}
+
+  def probe_task(self):
+    # reset timer
+    self.probe_timer = new_timer(SSH_PROBE_INTERVAL, self.probe_task)
+    self.probe_timer.start()
+
+    # do work: drop dead transports, so sync won't wait on them
+    for sock, ssh in list(self.pool.items()):
+      transport = ssh.get_transport()
+      if transport is None or not transport.is_active():
+        self.mark_broken(sock, 'transport inactive')
+    # and reconnect the known-down ones whose probe window has come, so sync won't pay the connect timeout
+    for sock in TRACKED_SOCKETS:
+      if sock not in self.pool and self.health[sock].state == 'probing':
+        self.get(sock)
+
+auth_verifiers = { }        # {'name': fn(sock, username, password) -> True | False | None (error)}
+
+def auth_verifier(name:str):
+  def wrapper(fn):
+    auth_verifiers[name] = fn
+    return fn
+  return wrapper
+
+@auth_verifier('ssh')
+def ssh_verifier(sock:Tuple[str, int], username:str, password:str) -> bool:
+  # a real password login to the target host, the most faithful but a full handshake costs seconds
+  return SshPool.test_login(sock, username, password)
+
+@auth_verifier('pam')
+def pam_verifier(sock:Tuple[str, int], username:str, password:str) -> bool:
+  # against PAM on the sodayo host, NOTE: needs `python-pam`, and accounts shared with GPU hosts (eg. by LDAP/NIS)
+  try:
+    import pam
+    return pam.authenticate(username, password)
+  except:
+    logger.error(format_exc())
+    return None
+
+@auth_verifier('shadow')
+def shadow_verifier(sock:Tuple[str, int], username:str, password:str) -> bool:
+  # against '/etc/shadow' on the sodayo host, NOTE: needs root, and `spwd` & `crypt` are removed since python 3.13
+  try:
+    import spwd, crypt
+    try: hashed = spwd.getspnam(username).sp_pwdp
+    except KeyError: return False
+    return hmac.compare_digest(crypt.crypt(password, hashed), hashed)
+  except:
+    logger.error(format_exc())
+    return None
+
+@auth_verifier('static')
+def static_verifier(sock:Tuple[str, int], username:str, password:str) -> bool:
+  # a local stand-in for dev/test, against the sha256 hexdigests in AUTH_STATIC_PASSWD
+  if username not in AUTH_STATIC_PASSWD: return False
+  return hmac.compare_digest(sha256(password.encode()).hexdigest(), AUTH_STATIC_PASSWD[username])
+
+class AuthVerifier:
+
+  def __init__(self):
+    self.verify_fn = auth_verifiers[AUTH_VERIFIER]
+    self.salt  = os.urandom(16)   # per process, so the cached hashes are useless anywhere else
+    self.cache = OrderedDict()    # {(username, salted_password_hash): (ok:bool, expire_ts)}, in LRU order
+    self.lock  = Lock()
+
+  def verify(self, sock:Tuple[str, int], username:str, password:str) -> bool:
+    key = (username, hmac.new(self.salt, password.encode(), sha256).digest())
+    with self.lock:
+      hit = self.cache.get(key)
+      if hit and hit[1] > now_ts():
+        self.cache.move_to_end(key)
+        return hit[0]
+
+    # NOTE: the verifying itself runs out of lock, so that users don't wait for each other
+    logger.info(f'[AuthVerifier] {AUTH_VERIFIER} for {username!r}')
+    r = self.verify_fn(sock, username, password)
+    if r is None: return r      # internal error, do not cache
+
+    with self.lock:
+      self.cache[key] = (r, now_ts() + (r and AUTH_CACHE_TTL or AUTH_FAIL_TTL))
+      self.cache.move_to_end(key)
+      while len(self.cache) > AUTH_CACHE_SIZE:
+        self.cache.popitem(last=False)
+    return r
+
+class GpustatAgent:
+
+  # NOTE: fed to a remote `python -u -` via stdin, so no shell quoting hell as in `SshBackend.query`
+  # it holds an NVML reference for its whole life, and prints one JSON line per round, 
+  # containing only the GPUs changed since last round (so the 1st line is a full snapshot)
+  SCRIPT = '''
+import sys, json, time, pynvml, gpustat
+pynvml.nvmlInit()
+last = { }
+while True:
+  r = gpustat.new_query().jsonify()
+  r.pop('query_time', None)
+  gpus = {g['index']: g for g in r['gpus']}
+  delta = [g for i, g in gpus.items() if last.get(i) != g]
+  gone = [i for i in last if i not in gpus]
+  sys.stdout.write(json.dumps({'hostname': r['hostname'], 'gpus': delta, 'gone': gone}) + '\\n')
+  sys.stdout.flush()
+  last = gpus
+  time.sleep(%d)
+'''
+  RELAUNCH_BACKOFF = (60, 3600)   # seconds, range of backoff before relaunching one failed repeatedly
+
+  def __init__(self, ssh:SSHClient):
+    logger.info('[GpustatAgent.new]')
+
+    self.ssh = ssh              # the pooled client it lives on
+    self.hostname = None
+    self.gpus = { }             # {gpu_id: gpustat_dict}, merged from deltas
+    self.last_ts = 0            # when the last line arrived, also serves as heartbeat
+    self.lock = Lock()
+    self.ready = Event()        # set after the first full snapshot arrives, or the stream ends
+
+    stdin, stdout, stderr = ssh.exec_command('python -u -')
+    stdin.write(self.SCRIPT % AGENT_INTERVAL)
+    stdin.flush()
+    stdin.channel.shutdown_write()    # EOF, let remote python start running the script
+    self.stdout = stdout
+
+    self.thread = Thread(target=self._pump, daemon=True)
+    self.thread.start()
+
+  def _pump(self):
+    try:
+      for line in self.stdout:
+        r = loads(line)
+        with self.lock:
+          self.hostname = r['hostname']
+          for gpu in r['gpus']: self.gpus[gpu['index']] = gpu
+          for gpu_id in r['gone']: self.gpus.pop(gpu_id, None)
+          self.last_ts = now_ts()
+        self.ready.set()
+    except Exception:
+      logger.error(f'[GpustatAgent] stream broken: {format_exc()}')
+    finally:
+      # tell why the remote side ends, eg. no pynvml there
+      channel, err = self.stdout.channel, b''
+      while channel.recv_stderr_ready(): err += channel.recv_stderr(4096)
+      if err: logger.warning(f'[GpustatAgent] remote stderr: {err.decode(errors="replace").strip()[-1000:]}')
+      channel.close()
+      self.ready.set()    # NOTE: wake `snapshot()` at once, rather than after its timeout
+
+  @property
+  def failed(self) -> bool:
+    # the stream ended before the first snapshot
+    return not self.thread.is_alive() and self.hostname is None
+
+  @property
+  def alive(self) -> bool:
+    # NOTE: silent for 3 rounds means the remote side is stuck or gone
+    if not self.thread.is_alive(): return False
+    return not self.ready.is_set() or now_ts() - self.last_ts < AGENT_INTERVAL * 3
+
+  def snapshot(self, timeout:float=None) -> dict:
+    # same shape with one-shot gpustat query in `SshBackend.query`, or None if not ready in time
+    if not self.ready.wait(timeout): return None
+    with self.lock:
+      if self.hostname is None: return None     # ended before the first snapshot
+      return {'hostname': self.hostname, 'gpus': [self.gpus[k] for k in sorted(self.gpus)], 'query_ts': self.last_ts}
+
+  def close(self):
+    self.stdout.channel.close()
+
+host_backends = { }         # {'name': class}, how to reach the GPU hosts, see `SshBackend` for the interface
+
+def host_backend(name:str):
+  def wrapper(cls):
+    host_backends[name] = cls
+    return cls
+  return wrapper
+
+@host_backend('ssh')
+class SshBackend:
+
+  ''' the real hosts over pooled ssh, and the interface any host backend should provide:
+      `start()`, `stop()`, `stats()`, `health`, `query(sock)`, `topology(sock)` & `kill(sock, gpu_ids)` '''
+
+  # NOTE: fed to a remote `python -u -` via stdin like `GpustatAgent.SCRIPT`, query & kill all in one round trip
+  # SIGTERM all processes on the victim GPUs, wait a grace period, then SIGKILL the survivors
+  KILL_SCRIPT = '''
+import os, sys, json, time, signal, gpustat
+gpu_ids, grace = %r, %r
+procs = [dict(p, gpu=g['index']) for g in gpustat.new_query().jsonify()['gpus'] if g['index'] in gpu_ids for p in g['processes']]
+def alive(pid):   # NOTE: a zombie is dead already, just waiting for its parent to reap
+  try: return open('/proc/' + str(pid) + '/stat').read().rsplit(')', 1)[1].split()[0] != 'Z'
+  except OSError: return False
+def signal_to(proc, sig, ok):
+  try: os.kill(proc['pid'], sig); proc['result'] = ok
+  except ProcessLookupError: proc['result'] = 'gone'
+  except PermissionError: proc['result'] = 'denied'
+for p in procs: signal_to(p, signal.SIGTERM, 'term')
+deadline = time.time() + grace
+while time.time() < deadline and any(p['result'] == 'term' and alive(p['pid']) for p in procs): time.sleep(0.2)
+for p in procs:
+  if p['result'] != 'term': continue
+  if alive(p['pid']): signal_to(p, signal.SIGKILL, 'killed')
+  else: p['result'] = 'terminated'
+print(json.dumps([{k: p.get(k) for k in ['pid', 'username', 'command', 'gpu', 'result']} for p in procs]))
+'''
+
+  def __init__(self):
+    self.ssh_pool = SshPool()
+    self.agents   = { }     # { sock(str,int): GpustatAgent }, only used when GPUSTAT_AGENT
+    self.agent_fails = { }  # { sock(str,int): (fails, retry_ts) }, of agents ending before the first snapshot
+
+  @property
+  def health(self) -> DefaultDict:
+    return self.ssh_pool.health   # { sock(str,int): HostHealth }
+
+  def start(self):
+    self.ssh_pool.start()
+
+  def stop(self):
+    for agent in self.agents.values(): agent.close()
+    self.ssh_pool.destroy()
+
+  def stats(self) -> dict:
+    return self.ssh_pool.stats()
+
+  def _get(self, sock:Tuple[str, int]) -> SSHClient:
+    ssh = self.ssh_pool.get(sock)
+    if ssh is None: raise SSHException(f'{sock_to_hostport(sock)} is down')
+    return ssh
+
+  def query(self, sock:Tuple[str, int]) -> dict:
+    ''' gpustat json of the host, plus 'query_ts' '''
+
+    ssh = self._get(sock)
+    try:
+      if GPUSTAT_AGENT:
+        res = self._query_agent(sock, ssh)
+        if res: return res
+        if sock not in self.agent_fails:
+          logger.warning(f'  << agent not ready for {sock_to_hostport(sock)}, fallback to one-shot query')
+
+      # NOTE: dict key 'queyr_time' should be removed, cos' type `datetime` is not JSON serializable
+      # but `del['queyr_time']` does NOT work due to some `eval()` function closure issues, so we keep this `pop()[1]` magic :)
+      py_cmd = 'import gpustat, json; r = gpustat.new_query().jsonify(); r.pop(list(r.keys())[1]); print(json.dumps(r))'
+      sh_cmd = f'python -c "{py_cmd}"'
+      stdin, stdout, stderr = ssh.exec_command(sh_cmd, timeout=SSH_TIMEOUT)
+      res = loads(stdout.read().strip())
+      res['query_ts'] = now_ts()
+      return res
+    except Exception as e:
+      self.ssh_pool.mark_broken(sock, repr(e))
+      raise
+
+  def _query_agent(self, sock:Tuple[str, int], ssh:SSHClient) -> dict:
+    agent = self.agents.get(sock)
+    if agent and agent.failed:    # relaunch at once, then back off if it keeps failing, the one-shot query serves meanwhile
+      del self.agents[sock]
+      fails = self.agent_fails.get(sock, (0, 0))[0] + 1
+      lo, hi = GpustatAgent.RELAUNCH_BACKOFF
+      backoff = fails > 1 and min(lo * 2 ** (fails - 2), hi) or 0
+      self.agent_fails[sock] = (fails, now_ts() + backoff)
+      logger.warning(f'  << agent failed for {sock_to_hostport(sock)} ({fails} times), relaunch in {backoff}s')
+      agent = None
+    if now_ts() < self.agent_fails.get(sock, (0, 0))[1]: return None
+
+    # (re)launch when missing, dead, or the pooled client it lives on has been replaced
+    if agent is None or agent.ssh is not ssh or not agent.alive:
+      if agent: agent.close()
+      agent = self.agents[sock] = GpustatAgent(ssh)
+    res = agent.snapshot(timeout=SSH_TIMEOUT)
+    if res: self.agent_fails.pop(sock, None)
+    return res
+
+  def topology(self, sock:Tuple[str, int]) -> str:
+    ''' output of `nvidia-smi topo -m` on the host '''
+
+    stdin, stdout, stderr = self._get(sock).exec_command('nvidia-smi topo -m', timeout=SSH_TIMEOUT)
+    return stdout.read().decode()
+
+  def kill(self, sock:Tuple[str, int], gpu_ids:list) -> list:
+    ''' kill all processes on `gpu_ids` of the host, returns [{'pid', 'username', 'command', 'gpu', 'result'}] '''
+
+    stdin, stdout, stderr = self._get(sock).exec_command('python -u -', timeout=SSH_TIMEOUT + KILL_GRACE)
+    stdin.write(self.KILL_SCRIPT % (list(gpu_ids), KILL_GRACE))
+    stdin.flush()
+    stdin.channel.shutdown_write()
+    return loads(stdout.read().strip())
+
+@host_backend('sim')
+class SimBackend:
+
+  ''' in-process simulated hosts, for benchmarks & development without GPUs
+      each host of TRACKED_SOCKETS has SIM_GPUS cards, randomly taken & released by SIM_USERS at each query '''
+
+  class Host:
+
+    def __init__(self, hostname:str, seed:int):
+      self.hostname = hostname
+      self.random = Random(seed)
+      self.lock = Lock()
+      self.next_pid = 1000
+      self.gpus = [[ ] for _ in range(SIM_GPUS)]    # [[{'pid', 'username', 'command', 'gpu_memory_usage'}]]
+
+    def churn(self):
+      for procs in self.gpus:
+        if self.random.random() >= SIM_CHURN: continue
+        if procs and self.random.random() < 0.5:
+          procs.pop(self.random.randrange(len(procs)))
+        else:
+          self.next_pid += 1
+          procs.append({'pid': self.next_pid, 'username': self.random.choice(SIM_USERS), 'command': 'python',
+                        'gpu_memory_usage': self.random.randrange(1000, 20000)})
+
+  def __init__(self):
+    self.hosts  = { }                     # { sock(str,int): SimBackend.Host }
+    self.health = defaultdict(HostHealth) # { sock(str,int): HostHealth }
+    self.random = Random(SIM_SEED)        # NOTE: only for latency & failure, hosts own theirs for reproducible states
+    for i, sock in enumerate(TRACKED_SOCKETS):
+      self.hosts[sock] = self.Host(sock[0], SIM_SEED + i)
+
+  def start(self): pass
+
+  def stop(self): pass
+
+  def stats(self) -> dict:
+    return {sock_to_hostport(sock): health.to_dict() for sock, health in list(self.health.items())}
+
+  def _roundtrip(self, sock:Tuple[str, int]) -> 'SimBackend.Host':
+    sleep(self.random.uniform(*SIM_LATENCY))
+    if self.random.random() < SIM_FAIL_RATE:
+      self.health[sock].fail('injected failure')
+      raise SSHException(f'{sock_to_hostport(sock)} injected failure')
+    self.health[sock].ok(0)
+    return self.hosts[sock]
+
+  def query(self, sock:Tuple[str, int]) -> dict:
+    host = self._roundtrip(sock)
+    with host.lock:
+      host.churn()
+      gpus = [{
+        'index': i,
+        'memory.used': sum(p['gpu_memory_usage'] for p in procs),
+        'memory.total': 24576,
+        'utilization.gpu': procs and host.random.randrange(30, 100) or 0,
+        'processes': [dict(p) for p in procs],
+      } for i, procs in enumerate(host.gpus)]
+    return {'hostname': host.hostname, 'gpus': gpus, 'query_ts': now_ts()}
+
+  def topology(self, sock:Tuple[str, int]) -> str:
+    # NVLink pairs within each half, across halves over the SMP interconnect
+    self._roundtrip(sock)
+    n = SIM_GPUS
+    link = lambda i, j: i == j and ' X ' or (i // 2 == j // 2 and 'NV2' or (i < n // 2) == (j < n // 2) and 'PHB' or 'SYS')
+    lines = ['\t'.join(f'GPU{j}' for j in range(n))]
+    lines += [f'GPU{i}\t' + '\t'.join(link(i, j) for j in range(n)) for i in range(n)]
+    return '\n'.join(lines) + '\n'
+
+  def kill(self, sock:Tuple[str, int], gpu_ids:list) -> list:
+    host = self._roundtrip(sock)
+    with host.lock:
+      procs = [ ]
+      for gpu_id in gpu_ids:
+        procs += [dict(p, gpu=gpu_id, result='terminated') for p in host.gpus[gpu_id]]
+        host.gpus[gpu_id] = [ ]
+    return [{k: p[k] for k in ['pid', 'username', 'command', 'gpu', 'result']} for p in procs]
+
+@host_backend('shard')
+class ShardBackend:
+
+  ''' on the aggregator, reaching hosts through the shards owning them, who report to us by `GpuMonitor.absorb()` '''
+
+  def __init__(self):
+    self.owners  = { }                    # { sock(str,int): 'shard_url' }
+    self.last_ts = { }                    # {'hostname': query_ts}, of the latest merged
+    self.seen_ts = { }                    # {'shard_url': ts}, of the last report
+    self.health  = defaultdict(HostHealth)  # { sock(str,int): HostHealth }, by reports
+
+  def start(self): pass
+
+  def stop(self): pass
+
+  def stats(self) -> dict:
+    r = {sock_to_hostport(sock): dict(health.to_dict(), shard=self.owners.get(sock)) for sock, health in list(self.health.items())}
+    return r
+
+  def seen(self, shard:str):
+    self.seen_ts[shard] = now_ts()
+
+  def is_newer(self, hostname:str, ts:float) -> bool:
+    return ts > self.last_ts.get(hostname, 0)
+
+  def own(self, sock:Tuple[str, int], hostname:str, shard:str, ts:float):
+    self.owners[sock] = shard
+    self.last_ts[hostname] = ts
+    self.health[sock].ok(0)
+
+  def stale(self) -> list:
+    ''' socks of hosts whose shard has not reported in SHARD_TIMEOUT '''
+    deadline = now_ts() - SHARD_TIMEOUT
+    socks = [sock for sock, shard in list(self.owners.items()) if self.seen_ts.get(shard, 0) <= deadline]
+    for sock in socks:
+      self.health[sock].fail(f'shard {self.owners.pop(sock)} silent')
+    return socks
+
+  def next_ts(self) -> float:
+    ''' when the next shard would be silent for SHARD_TIMEOUT, or SHARD_TIMEOUT later if no host owned yet '''
+    shards = set(self.owners.values())
+    return (shards and min(self.seen_ts.get(shard, 0) for shard in shards) or now_ts()) + SHARD_TIMEOUT
+
+  def _owner(self, sock:Tuple[str, int]) -> str:
+    if sock not in self.owners: raise SSHException(f'{sock_to_hostport(sock)} is owned by no shard')
+    return self.owners[sock]
+
+  def query(self, sock:Tuple[str, int]) -> dict:
+    raise SSHException('hosts are queried by shards')
+
+  def topology(self, sock:Tuple[str, int]) -> str:
+    host, port = sock
+    return http_call(f'{self._owner(sock)}/shard/topology?host={host}&port={port}')
+
+  def kill(self, sock:Tuple[str, int], gpu_ids:list) -> list:
+    host, port = sock
+    return http_call(f'{self._owner(sock)}/shard/kill', {'host': host, 'port': port, 'gpu_ids': list(gpu_ids)},
+                     timeout=SSH_TIMEOUT + KILL_GRACE)
+
+class UsageAccountant:
+
+  def __init__(self):
+    self.occupancy = { }    # {'hostname': (card, user) matrix}, as of last observation, see `Occupancy.block()`
+    self.last_ts   = { }    # {'hostname': ts}, when the last observation was made
+
+  def is_newer(self, hostname:str, ts:float) -> bool:
+    return ts > self.last_ts.get(hostname, 0)
+
+  def elapsed(self, hostname:str, ts:float) -> float:
+    ''' seconds since last observation of this host, 0 if never seen '''
+    if hostname not in self.last_ts: return 0
+    # NOTE: a gap too long means we've lost sight of this host, cap it rather than guess
+    return min(ts - self.last_ts[hostname], min_to_sec(ACCOUNT_MAX_GAP))
+
+  def differs(self, hostname:str, block:np.ndarray) -> bool:
+    prev = self.occupancy.get(hostname)
+    if prev is None or len(prev) != len(block): return True
+    n = max(prev.shape[1], block.shape[1])
+    return not np.array_equal(pad_to(prev, n), pad_to(block, n))
+
+  def observe(self, hostname:str, block:np.ndarray, ts:float) -> np.ndarray:
+    ''' charge the elapsed time since last observation of this host, returns time_in_hour by user id '''
+
+    usage = np.zeros(block.shape[1])
+    if hostname in self.last_ts:
+      dt = sec_to_hour(self.elapsed(hostname, ts))
+      prev = self.occupancy[hostname]
+      # users seen at both ends held the card all along, while a change happened somewhere 
+      # in between, so those seen at only one end are charged a half (the midpoint estimate)
+      # NOTE: that is a half for each end seen on each card, so just sum over cards at both ends
+      usage = pad_to(usage, prev.shape[1])
+      usage[:prev.shape[1]] += prev.sum(axis=0) * (dt / 2)
+      usage[:block.shape[1]] += block.sum(axis=0) * (dt / 2)
+
+    self.occupancy[hostname] = block
+    self.last_ts[hostname] = ts
+    return usage
+
+  def forget(self, hostname:str):
+    # host lost, the interval since last observation is unknown, so nobody is charged for it
+    self.occupancy.pop(hostname, None)
+    self.last_ts.pop(hostname, None)
+
+class Occupancy:
+
+  ''' who is on which card, as a dense (card x user) boolean matrix, with users interned as columns,
+      and a host index to the rows, where each host has its cards on contiguous rows in order of gpu id
+      reads like {'hostname': {gpu_id: {'username'}}}, while bulk views are vectorized over the matrix '''
+
+  def __init__(self):
+    self.users    = [ ]         # ['username'], by user id
+    self.user_ids = { }         # {'username': user id}
+    self.hosts    = { }         # {'hostname': (first row, [gpu_id])}
+    self.matrix   = np.zeros((0, 0), dtype=bool)    # rows beyond `used` & columns beyond `len(users)` are spare
+    self.used     = 0           # rows taken, including holes left by hosts removed or resized
+    self.live     = 0           # rows of hosts indexed
+    self.lock     = RLock()     # NOTE: per-host writers are serialized by `host_lock()`, this guards the shared matrix
+
+  def intern(self, username:str) -> int:
+    if username not in self.user_ids:
+      self.user_ids[username] = len(self.users)
+      self.users.append(username)
+    return self.user_ids[username]
+
+  def _grow(self, n_rows:int, n_cols:int):
+    # by doubling, so that an append is amortized O(1)
+    rows, cols = self.matrix.shape
+    if n_rows <= rows and n_cols <= cols: return
+    matrix = np.zeros((n_rows > rows and max(n_rows, rows * 2) or rows, n_cols > cols and max(n_cols, cols * 2) or cols), dtype=bool)
+    matrix[:rows, :cols] = self.matrix
+    self.matrix = matrix
+
+  def _compact(self):
+    # move hosts down over the holes
+    row = 0
+    for hostname, (start, gpu_ids) in sorted(self.hosts.items(), key=lambda kv: kv[1][0]):
+      n = len(gpu_ids)
+      if start != row:
+        self.matrix[row:row + n] = self.matrix[start:start + n]
+        self.hosts[hostname] = (row, gpu_ids)
+      row += n
+    self.matrix[row:self.used] = False
+    self.used = row
+
+  def __setitem__(self, hostname:str, gpu_rt:dict):
+    gpu_ids = sorted(gpu_rt)
+    with self.lock:
+      cells = [(i, self.intern(username)) for i, gpu_id in enumerate(gpu_ids) for username in gpu_rt[gpu_id]]
+      if hostname in self.hosts and len(self.hosts[hostname][1]) == len(gpu_ids):
+        start = self.hosts[hostname][0]
+      else:
+        self.pop(hostname)
+        if self.used - self.live > self.live: self._compact()   # more holes than cards
+        start, self.used = self.used, self.used + len(gpu_ids)
+        self.live += len(gpu_ids)
+      self._grow(self.used, len(self.users))
+      block = self.matrix[start:start + len(gpu_ids)]
+      block[:] = False
+      if cells:
+        rows, cols = zip(*cells)
+        block[rows, cols] = True
+      self.hosts[hostname] = (start, gpu_ids)
+
+  def __getitem__(self, hostname:str) -> dict:
+    gpu_ids, block = self.block(hostname)
+    return {gpu_id: {self.users[user_id] for user_id in np.flatnonzero(row)} for gpu_id, row in zip(gpu_ids.tolist(), block)}
+
+  def __contains__(self, hostname:str) -> bool:
+    return hostname in self.hosts
+
+  def __len__(self) -> int:
+    return len(self.hosts)
+
+  def keys(self) -> list:
+    return list(self.hosts)
+
+  def pop(self, hostname:str, default=None):
+    with self.lock:
+      if hostname not in self.hosts: return default
+      start, gpu_ids = self.hosts.pop(hostname)
+      self.matrix[start:start + len(gpu_ids)] = False
+      self.live -= len(gpu_ids)
+
+  def clear(self):
+    with self.lock:
+      self.__init__()
+
+  def block(self, hostname:str) -> Tuple[np.ndarray, np.ndarray]:
+    ''' gpu ids and a copy of the (card, user) rows of the host '''
+
+    with self.lock:
+      start, gpu_ids = self.hosts[hostname]
+      return np.array(gpu_ids, dtype=int), self.matrix[start:start + len(gpu_ids), :len(self.users)].copy()
+
+  def to_names(self, vector:np.ndarray) -> dict:
+    ''' a vector by user id to {'username': value}, nonzero ones only '''
+
+    return {self.users[user_id]: float(vector[user_id]) for user_id in np.flatnonzero(vector)}
+
+  def to_serializable(self) -> dict:
+    ''' {'hostname': {gpu_id: ['username']}}, users sorted for a stable output '''
+
+    with self.lock:
+      rows, cols = np.nonzero(self.matrix[:self.used])
+      rank = np.argsort(np.argsort(self.users))     # usernames sorted on each card, by a stable sort within each row
+      order = np.lexsort((rank[cols], rows))
+      rows, cols = rows[order], cols[order]
+      users, hosts = list(self.users), dict(self.hosts)
+
+    # cut the (row, user_id) pairs by host
+    starts = np.array([start for start, _ in hosts.values()], dtype=int)
+    ends   = np.array([start + len(gpu_ids) for start, gpu_ids in hosts.values()], dtype=int)
+    los, his = np.searchsorted(rows, starts).tolist(), np.searchsorted(rows, ends).tolist()
+    rows, cols = rows.tolist(), cols.tolist()
+
+    runtime = { }
+    for (hostname, (start, gpu_ids)), lo, hi in zip(hosts.items(), los, his):
+      gpu_rt = runtime[hostname] = {gpu_id: [ ] for gpu_id in gpu_ids}
+      for row, user_id in zip(rows[lo:hi], cols[lo:hi]):
+        gpu_rt[gpu_ids[row - start]].append(users[user_id])
+    return runtime
+
+gpu_runtime = Occupancy()
+
+class HistoryStore:
+
+  # one row per (gpu, user) per observation, user 0 means the card is idle
+  # `dt` is seconds since last observation of the host, the usage charged is derived from it by `usage_matrix()`
+  DTYPE = np.dtype([
+    ('ts',        '<f8'),
+    ('dt',        '<f4'),
+    ('host',      '<u2'),     # index into `hosts`
+    ('gpu',       'u1'),
+    ('user',      '<u2'),     # index into `users`
+    ('util',      'u1'),      # utilization.gpu in %
+    ('mem_used',  '<u4'),     # in MiB
+    ('mem_total', '<u4'),     # in MiB
+  ])
+
+  def _get_fp(self, day:str) -> str:
+    return os.path.join(self.path, f'{day}.bin')
+
+  def __init__(self):
+    # day files 'YYYY-MM-DD.bin' of packed `DTYPE` rows, plus 'names.json' for the interned names
+    self.path = os.path.join(BASE_PATH, HISTORY_PATH)
+    self.names_fp = os.path.join(self.path, 'names.json')
+    self.hosts = [ ]          # ['hostname'], interned
+    self.users = [ '' ]       # ['username'], interned, 0 is reserved for idle
+    self.host_ids = { }       # {'hostname': int}
+    self.user_ids = { '': 0 } # {'username': int}
+    self.names_dirty = False
+    self.buffer = [ ]         # [(day, np.ndarray)], rows not flushed yet
+    self.lock = Lock()
+
+    os.makedirs(self.path, exist_ok=True)
+    if os.path.exists(self.names_fp):
+      with open(self.names_fp, 'r', encoding='utf8') as fh:
+        names = loads(fh.read())
+      self.hosts, self.users = names['hosts'], names['users']
+      self.host_ids = {name: i for i, name in enumerate(self.hosts)}
+      self.user_ids = {name: i for i, name in enumerate(self.users)}
+
+  def _intern(self, names:list, ids:dict, name:str) -> int:
+    if name not in ids:
+      ids[name] = len(names)
+      names.append(name)
+      self.names_dirty = True
+    return ids[name]
+
+  def record(self, hostname:str, gpu_rt:dict, gpu_stat:dict, ts:float, dt:float):
+    with self.lock:
+      host_id = self._intern(self.hosts, self.host_ids, hostname)
+      rows = [ ]
+      for gpu_id, users in gpu_rt.items():
+        stat = gpu_stat.get(gpu_id, {})
+        for user_id in [self._intern(self.users, self.user_ids, u) for u in sorted(users)] or [0]:
+          rows.append((ts, dt, host_id, gpu_id, user_id, stat.get('utilization.gpu', 0), stat.get('memory.used', 0), stat.get('memory.total', 0)))
+      day = datetime.fromtimestamp(ts).strftime('%Y-%m-%d')
+      self.buffer.append((day, np.array(rows, dtype=self.DTYPE)))
+
+  def flush(self):
+    with self.lock:
+      buffer, self.buffer = self.buffer, [ ]
+      names = self.names_dirty and dumps({'hosts': self.hosts, 'users': self.users})
+      self.names_dirty = False
+    if not buffer: return
+
+    # NOTE: names must land before the rows referring to them
+    if names:
+      with open(self.names_fp + '.tmp', 'w', encoding='utf8') as fh:
+        fh.write(names)
+      os.replace(self.names_fp + '.tmp', self.names_fp)
+
+    days = defaultdict(list)
+    for day, rows in buffer: days[day].append(rows)
+    for day, chunks in days.items():
+      with open(self._get_fp(day), 'ab') as fh:
+        fh.write(np.concatenate(chunks).tobytes())
+
+  def query(self, start_ts:float, end_ts:float, hostname:str=None, gpu_id:int=None, username:str=None) -> np.ndarray:
+    ''' rows in [start_ts, end_ts), filtered by the given conditions, at most the latest HISTORY_QUERY_LIMIT ones '''
+
+    empty = np.empty(0, dtype=self.DTYPE)
+    if hostname is not None and hostname not in self.host_ids: return empty
+    if username is not None and username not in self.user_ids: return empty
+
+    chunks = [ ]
+    day, last_day = datetime.fromtimestamp(start_ts).date(), datetime.fromtimestamp(end_ts).date()
+    while day <= last_day:
+      fp = self._get_fp(day.strftime('%Y-%m-%d'))
+      day += timedelta(days=1)
+
+      # NOTE: a row torn by crash at the tail is just ignored
+      cnt = os.path.exists(fp) and os.path.getsize(fp) // self.DTYPE.itemsize
+      if not cnt: continue
+      rows = np.memmap(fp, dtype=self.DTYPE, mode='r', shape=(cnt,))
+      mask = (rows['ts'] >= start_ts) & (rows['ts'] < end_ts)
+      if hostname is not None: mask &= rows['host'] == self.host_ids[hostname]
+      if gpu_id   is not None: mask &= rows['gpu'] == gpu_id
+      if username is not None: mask &= rows['user'] == self.user_ids[username]
+      chunks.append(np.array(rows[mask]))
+
+    if not chunks: return empty
+    return np.concatenate(chunks)[-HISTORY_QUERY_LIMIT:]
+
+  def usage_matrix(self, start_ts:float, end_ts:float) -> np.ndarray:
+    ''' hours charged in [start_ts, end_ts) as a matrix of shape (len(hosts), len(users)) '''
+
+    # NOTE: the same midpoint estimate as `UsageAccountant.observe()`, that an observation of a host charges `dt/2` 
+    # to the users seen at it, and `dt/2` to those seen at the previous one, so a row is charged a half of its own `dt`
+    # and a half of the next observation's, both at the time of charge by the ledger
+    n_hosts, n_users = len(self.hosts), len(self.users)
+    usage = np.zeros(n_hosts * n_users)
+    pending = np.empty(0, dtype=self.DTYPE)     # rows of the last observation of each host on days before, waiting for the next one
+    in_window = lambda ts: (ts >= start_ts) & (ts < end_ts)
+    cells = lambda rows: rows['host'].astype(np.int64) * n_users + rows['user']
+    day, last_day = datetime.fromtimestamp(start_ts).date() - timedelta(days=1), datetime.fromtimestamp(end_ts).date()
+    while day <= last_day:
+      fp = self._get_fp(day.strftime('%Y-%m-%d'))
+      day += timedelta(days=1)
+
+      cnt = os.path.exists(fp) and os.path.getsize(fp) // self.DTYPE.itemsize
+      if not cnt: continue
+      rows = np.memmap(fp, dtype=self.DTYPE, mode='r', shape=(cnt,))
+      # NOTE: names interned after we started may come along with newly flushed rows, leave them out
+      rows = np.array(rows[(rows['host'] < n_hosts) & (rows['user'] < n_users)])
+      mask = in_window(rows['ts'])
+      usage += np.bincount(cells(rows[mask]), weights=rows['dt'][mask] / 2, minlength=n_hosts * n_users)
+
+      # observations are the runs of rows of the same host & ts
+      rows = np.concatenate([pending, rows])
+      rows = rows[np.lexsort((rows['ts'], rows['host']))]
+      first = np.ones(len(rows), dtype=bool)
+      first[1:] = (rows['host'][1:] != rows['host'][:-1]) | (rows['ts'][1:] != rows['ts'][:-1])
+      obs = np.cumsum(first) - 1
+      obs_host, obs_ts, obs_dt = rows['host'][first], rows['ts'][first], rows['dt'][first]
+      has_next = np.append(obs_host[1:] == obs_host[:-1], False)[obs]
+      next_ts, next_dt = np.append(obs_ts[1:], 0)[obs], np.append(obs_dt[1:], 0)[obs]
+      mask = has_next & in_window(next_ts)
+      usage += np.bincount(cells(rows[mask]), weights=next_dt[mask] / 2, minlength=n_hosts * n_users)
+      pending = rows[~has_next]
+
+    return usage.reshape(n_hosts, n_users) / 3600
+
+  def to_columns(self, rows:np.ndarray) -> dict:
+    # columnar JSON, with names resolved
+    hosts, users = np.array(self.hosts), np.array(self.users)
+    r = {k: rows[k].tolist() for k in ['ts', 'dt', 'gpu', 'util', 'mem_used', 'mem_total']}
+    r['host'] = hosts[rows['host']].tolist()
+    r['user'] = users[rows['user']].tolist()
+    return r
+
+class UsageReport:
+
+  QUOTA_FILE_REGEX = Regex(r'^quota_(\d{4}-\d{2})\.txt$')
+
+  def __init__(self, quota_tracker:QuotaTracker, fairshare:'FairShare', history:HistoryStore=None):
+    self.quota_tracker = quota_tracker
+    self.fairshare = fairshare
+    self.history = history
+
+  def load_months(self) -> Tuple[list, list, np.ndarray]:
+    ''' remnants at the end of each past month, as (months, usernames, matrix of shape (len(months), len(usernames)), nan for absence) '''
+
+    data_path = os.path.join(BASE_PATH, DATA_PATH)
+    current = os.path.basename(self.quota_tracker.current_fp or '')
+    months, infos = [ ], [ ]
+    for fn in sorted(os.listdir(data_path)) if os.path.isdir(data_path) else [ ]:
+      m = self.QUOTA_FILE_REGEX.match(fn)
+      if not m or fn == current: continue    # NOTE: the current month is taken from memory, fresher than file
+      info = { }
+      QuotaTracker.parse(os.path.join(data_path, fn), info)
+      months.append(m.group(1))
+      infos.append(info)
+
+    usernames = sorted({u for info in infos for u in info})
+    user_ids = {u: i for i, u in enumerate(usernames)}
+    remnants = np.full((len(months), len(usernames)), np.nan)
+    for i, info in enumerate(infos):
+      remnants[i, [user_ids[u] for u in info]] = list(info.values())
+    return months, usernames, remnants
+
+  def build(self, days:float) -> dict:
+    now = now_ts()
+    since = now - days * 24 * 3600
+
+    with quota_lock:
+      remnant = dict(self.quota_tracker.query())
+      allotment = dict(self.quota_tracker.allotment)
+      priority = dict(self.fairshare.priority)
+
+    # align everything onto users of this month
+    usernames = sorted(remnant)
+    user_ids = {u: i for i, u in enumerate(usernames)}
+    allot = np.array([allotment.get(u, np.nan) for u in usernames])
+    remain = np.array([remnant[u] for u in usernames])
+    used = allot - remain     # in this month so far
+
+    # usage by host & by user within the window, from history if available
+    hostnames, window = [ ], np.zeros(len(usernames))
+    host_usage = np.zeros(0)
+    if self.history:
+      matrix = self.history.usage_matrix(since, now)    # (hosts, users_interned)
+      hostnames = list(self.history.hosts[:matrix.shape[0]])
+      host_usage = matrix[:, 1:].sum(axis=1)            # NOTE: user 0 is idle
+      cols = [(user_ids[u], i) for i, u in enumerate(self.history.users[:matrix.shape[1]]) if u in user_ids]
+      if cols:
+        dst, src = zip(*cols)
+        window[list(dst)] = matrix[:, list(src)].sum(axis=0)
+      burn_rate = window / days                         # hours per day
+    else:
+      month_begin = datetime.timestamp(datetime.now().replace(day=1, hour=0, minute=0, second=0, microsecond=0))
+      burn_rate = used / max((now - month_begin) / (24 * 3600), 1e-6)
+
+    # projected exhaustion, and whether it comes before the monthly reset
+    next_month = (datetime.now().replace(day=1) + timedelta(days=32)).replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+      days_left = np.where(remain <= 0, 0, np.where(burn_rate > 0, remain / burn_rate, np.inf))
+      exhaust_ts = now + days_left * 24 * 3600
+      # fair share: the actual share of usage minus the entitled share of allotment, the lower the more underserved
+      # NOTE: those with no allotment (eg. added to the month file by hand) have no share, nan, and are left out of the sums
+      share_target = allot / np.nansum(allot)
+      total_used = np.nansum(used)
+      share_actual = used / total_used if total_used > 0 else np.where(np.isnan(used), np.nan, 0)
+      share_delta = share_actual - share_target
+    rank = np.empty(len(usernames), dtype=int)
+    rank[np.argsort(np.nan_to_num(share_delta, nan=np.inf), kind='stable')] = np.arange(1, len(usernames) + 1)
+
+    months, month_users, month_remnants = self.load_months()
+    month_allot = np.array([allotment.get(u, np.nan) for u in month_users])
+    month_used = month_allot[None, :] - month_remnants   # NOTE: assumes the rules unchanged since then
+
+    finite = lambda x: None if not np.isfinite(x) else float(x)
+    return {
+      'window': {'since': since, 'until': now, 'days': days},
+      'users': {u: {
+        'allotment':    finite(allot[i]),
+        'remnant':      float(remain[i]),
+        'used':         finite(used[i]),
+        'window_used':  float(window[i]),
+        'burn_rate':    finite(burn_rate[i]),
+        'exhaust_ts':   finite(exhaust_ts[i]),
+        'exhaust_before_reset': bool(exhaust_ts[i] < datetime.timestamp(next_month)),
+        'share_target': finite(share_target[i]),
+        'share_actual': finite(share_actual[i]),
+        'rank':         int(rank[i]),
+        'priority':     priority.get(u, 0),
+      } for i, u in enumerate(usernames)},
+      'hosts': {h: float(host_usage[i]) for i, h in enumerate(hostnames)},
+      'months': {mon: {u: float(month_used[i, j]) for j, u in enumerate(month_users) if np.isfinite(month_used[i, j])}
+                 for i, mon in enumerate(months)},
+    }
+
+class FairShare:
+
+  '''
+    priority of a user is `2 ** (-usage_share / allot_share)` in (0, 1], where
+      - usage_share: the user's share in the decayed recent usage of all users, halves every FAIRSHARE_HALF_LIFE
+      - allot_share: the user's share in the monthly allotments of all users
+    so a user having used exactly the fair share is at 0.5, an idle one at 1, those out of quota or untracked at 0
+  '''
+
+  def __init__(self):
+    self.usage    = { }     # {'username': decayed_hours}
+    self.priority = { }     # {'username': float}
+    self.last_ts  = now_ts()
+
+  def seed(self, allotment:dict, quotas:dict):
+    # NOTE: no usage record to decay from after a (re)load, take what was used this month as a rough start
+    self.usage = {u: max(allotment.get(u, 0) - q, 0) for u, q in quotas.items()}
+    self.last_ts = now_ts()
+
+  def charge(self, usage:dict):
+    ts = now_ts()
+    decay = 0.5 ** (sec_to_hour(ts - self.last_ts) / FAIRSHARE_HALF_LIFE)
+    self.last_ts = ts
+    for username in self.usage:
+      self.usage[username] *= decay
+    for username, time_in_hour in usage.items():
+      self.usage[username] = self.usage.get(username, 0) + time_in_hour
+
+  def compute(self, allotment:dict, quotas:dict) -> dict:
+    allot_sum = sum(v for v in allotment.values() if v > 0) or 1
+    usage_sum = sum(self.usage.values()) or 1
+    self.priority = { }
+    for username, quota in quotas.items():
+      allot_share = allotment.get(username, 0) / allot_sum
+      if quota <= 0 or allot_share <= 0: prio = 0.0
+      else: prio = 2 ** (-self.usage.get(username, 0) / usage_sum / allot_share)
+      self.priority[username] = prio
+    return self.priority
+
+class AllocIndex:
+
+  def __init__(self):
+    self.blocks    = { }                # {'hostname': (gpu_ids, (card, user) matrix)}, copy of what is indexed, see `Occupancy.block()`
+    self.free      = { }                # {'hostname': {gpu_id}}
+    self.killable  = { }                # {'hostname': {gpu_id}}, busy ones, killable by those of higher priority than its users
+    self.priority  = { }                # {'username': float}, by `FairShare`, untracked users are at 0
+    self.prio_vec  = np.zeros(0)        # `priority` by user id of `gpu_runtime`
+    self.victims   = { }                # {'hostname': victim priority of each card}, cached till the host or priorities change
+    self.stats     = { }                # {'hostname': {gpu_id: {'memory.used': int, ...}}}
+    self.stale     = set()              # {'hostname'}, indexed by outdated info, see `GpuMonitor.restore()`
+    self.reserved  = { }                # {(hostname, gpu_id): expire_ts}, handed out recently, not to be handed out again
+    # hosts sorted by capability, so that a request for N GPUs is a bisect
+    self.by_free   = [ ]                # [(free_cnt, 'hostname')]
+    self.by_avail  = [ ]                # [(free_cnt + killable_cnt, 'hostname')], an upper bound regardless of priority
+    # and by the priority needed to take k cards of a host, free ones first, then killable ones of the lowest victim priority,
+    # so that a preempting request of k GPUs is a bisect too, NOTE: rebuilt lazily once priorities change, see `_rank_needed()`
+    self.by_needed = { }                # {k: [(priority_needed, 'hostname')]}, for k in 1..MAX_REALLOC_COUNT
+    self.needed    = None               # {'hostname': [priority_needed of k = 1, 2, ...]}, as ranked, None if outdated
+
+  @staticmethod
+  def _discard(ranks:list, item:tuple):
+    i = bisect_left(ranks, item)
+    if i < len(ranks) and ranks[i] == item: ranks.pop(i)
+
+  def _rank(self, hostname:str):
+    free_cnt, killable_cnt = len(self.free[hostname]), len(self.killable[hostname])
+    insort(self.by_free, (free_cnt, hostname))
+    insort(self.by_avail, (free_cnt + killable_cnt, hostname))
+    if self.needed is not None:
+      self.needed[hostname] = needed = self._priority_needed(hostname)
+      for k, p in enumerate(needed, 1): insort(self.by_needed[k], (p, hostname))
+
+  def _unrank(self, hostname:str):
+    free_cnt, killable_cnt = len(self.free[hostname]), len(self.killable[hostname])
+    self._discard(self.by_free, (free_cnt, hostname))
+    self._discard(self.by_avail, (free_cnt + killable_cnt, hostname))
+    if self.needed is not None:
+      for k, p in enumerate(self.needed.pop(hostname, [ ]), 1): self._discard(self.by_needed[k], (p, hostname))
+
+  def _priority_needed(self, hostname:str) -> list:
+    # one needs a priority above the k-th to take k cards of the host, -inf for free ones
+    gpu_ids, _ = self.blocks[hostname]
+    killable = self.killable[hostname]
+    victims = sorted(p for gpu_id, p in zip(gpu_ids.tolist(), self.victim_priorities(hostname).tolist()) if gpu_id in killable)
+    return ([-inf] * len(self.free[hostname]) + victims)[:MAX_REALLOC_COUNT]
+
+  def _rank_needed(self):
+    # NOTE: priorities change on each publish while preemptions are rare, so rank all hosts only on the first one since,
+    # that is O(hosts x GPUs) once, then O(log hosts) for each preempting request till priorities change again
+    if self.needed is not None: return
+    self.needed = {hostname: self._priority_needed(hostname) for hostname in self.blocks}
+    self.by_needed = {k: [ ] for k in range(1, MAX_REALLOC_COUNT + 1)}
+    for hostname, needed in self.needed.items():
+      for k, p in enumerate(needed, 1): self.by_needed[k].append((p, hostname))
+    for ranks in self.by_needed.values(): ranks.sort()
+
+  def victim_priorities(self, hostname:str) -> np.ndarray:
+    # a card is killable only by one of higher priority than all users on it
+    if hostname not in self.victims:
+      _, block = self.blocks[hostname]
+      prio_vec = pad_to(self.prio_vec[:block.shape[1]], block.shape[1])    # NOTE: those interned since are untracked yet, at 0
+      self.victims[hostname] = np.where(block, prio_vec, 0).max(axis=1, initial=0)
+    return self.victims[hostname]
+
+  def victim_priority(self, hostname:str, gpu_id:int) -> float:
+    gpu_ids, _ = self.blocks[hostname]
+    return float(self.victim_priorities(hostname)[np.searchsorted(gpu_ids, gpu_id)])
+
+  def killable_below(self, hostname:str, priority:float) -> list:
+    gpu_ids, _ = self.blocks[hostname]
+    below = gpu_ids[self.victim_priorities(hostname) < priority].tolist()
+    return [gpu_id for gpu_id in below if gpu_id in self.killable[hostname]]
+
+  def _is_reserved(self, hostname:str, gpu_id:int) -> bool:
+    return self.reserved.get((hostname, gpu_id), 0) > now_ts()
+
+  def update_host(self, hostname:str, gpu_ids:np.ndarray, block:np.ndarray, gpu_stat:dict=None, stale:bool=False):
+    self.remove_host(hostname)
+
+    gpu_stat = gpu_stat or { }
+    self.blocks[hostname] = (gpu_ids, block)
+    self.stats[hostname] = gpu_stat
+    if stale: self.stale.add(hostname)
+    reserved = np.zeros(len(gpu_ids), dtype=bool)
+    if self.reserved:
+      for i, gpu_id in enumerate(gpu_ids.tolist()):
+        if (hostname, gpu_id) not in self.reserved: continue
+        if self._is_reserved(hostname, gpu_id): reserved[i] = True
+        else: del self.reserved[(hostname, gpu_id)]
+
+    # NOTE: a card with no process but resident memory (eg. by a container invisible to us) is not really free
+    busy     = block.any(axis=1)
+    resident = np.array([gpu_stat.get(gpu_id, {}).get('memory.used', 0) > FREE_MEMORY_THRESHOLD for gpu_id in gpu_ids.tolist()], dtype=bool)
+    self.free[hostname]     = set(gpu_ids[~busy & ~resident & ~reserved].tolist())
+    self.killable[hostname] = set(gpu_ids[busy & ~reserved & (not stale)].tolist())   # NOTE: never kill by outdated info
+    self._rank(hostname)
+
+  def remove_host(self, hostname:str):
+    if hostname not in self.blocks: return
+
+    self._unrank(hostname)
+    del self.blocks[hostname], self.free[hostname], self.killable[hostname], self.stats[hostname]
+    self.victims.pop(hostname, None)
+    self.stale.discard(hostname)
+
+  def update_priority(self, priority:dict):
+    # NOTE: the ranks but `by_needed` hold regardless of priority
+    self.priority = priority
+    self.prio_vec = np.array([priority.get(username, 0) for username in list(gpu_runtime.users)], dtype=float)
+    self.victims.clear()
+    self.needed = None
+
+  def reserve(self, hostname:str, gpu_ids:list):
+    # keep cards just handed out from being handed out again, until REALLOC_RESERVE expires
+    expire_ts = now_ts() + REALLOC_RESERVE
+    self._unrank(hostname)
+    for gpu_id in gpu_ids:
+      self.reserved[(hostname, gpu_id)] = expire_ts
+      self.free[hostname].discard(gpu_id)
+      self.killable[hostname].discard(gpu_id)
+    self._rank(hostname)
+
+  def release(self, hostname:str, gpu_ids:list):
+    for gpu_id in gpu_ids:
+      self.reserved.pop((hostname, gpu_id), None)
+    if hostname in self.blocks:
+      self.update_host(hostname, *self.blocks[hostname], self.stats[hostname], hostname in self.stale)
+
+  def candidates(self, gpu_count:int, with_kill:bool=False, limit:int=None, priority:float=None) -> list:
+    # at most `limit` random ones among hosts having enough free (or free + killable by `priority`) GPUs
+    if with_kill and priority is not None and gpu_count <= MAX_REALLOC_COUNT:
+      self._rank_needed()
+      ranks = self.by_needed[gpu_count]
+      hostnames = [hostname for _, hostname in ranks[:bisect_left(ranks, (priority, ''))]]
+      return sample(hostnames, min(len(hostnames), limit or len(hostnames)))
+
+    ranks = with_kill and self.by_avail or self.by_free
+    i = bisect_left(ranks, (gpu_count, ''))
+    hostnames = [hostname for _, hostname in ranks[i:]]
+    if with_kill and priority is not None:    # the bisect is an upper bound, now check each
+      hostnames = [h for h in hostnames if len(self.free[h]) + len(self.killable_below(h, priority)) >= gpu_count]
+    return sample(hostnames, min(len(hostnames), limit or len(hostnames)))
+
+placement_policies = { }    # {'name': fn(AllocIndex, hostname, gpu_ids, killed_gpu_ids) -> score in [0, 1]}
+
+def placement_policy(name:str):
+  def wrapper(fn):
+    placement_policies[name] = fn
+    return fn
+  return wrapper
+
+@placement_policy('pack')
+def pack_policy(index:AllocIndex, hostname:str, gpu_ids:tuple, killed:tuple) -> float:
+  # prefer the host left with less free GPUs, keeping large free blocks for large jobs
+  left = len(index.free[hostname]) + len(killed) - len(gpu_ids)
+  return 1 - left / len(index.blocks[hostname][0])
+
+@placement_policy('spread')
+def spread_policy(index:AllocIndex, hostname:str, gpu_ids:tuple, killed:tuple) -> float:
+  # prefer the host left with more free GPUs, balancing load across hosts
+  return 1 - pack_policy(index, hostname, gpu_ids, killed)
+
+@placement_policy('locality')
+def locality_policy(index:AllocIndex, hostname:str, gpu_ids:tuple, killed:tuple) -> float:
+  # prefer cards well connected to each other (NVLink > PCIe switch > host bridge > across NUMA)
+  if len(gpu_ids) < 2: return 1
+  topo = gpu_topology.get(hostname)
+  if not topo: return 0.5     # unknown yet
+  links = [topo.get((i, j), 0) for i, j in combinations(gpu_ids, 2)]
+  return sum(links) / len(links) / max(topo.values())
+
+@placement_policy('memory')
+def memory_policy(index:AllocIndex, hostname:str, gpu_ids:tuple, killed:tuple) -> float:
+  # prefer cards with less resident memory, NOTE: cards to kill on would be emptied
+  stats = gpu_stats.get(hostname, {})
+  free_ratio = lambda stat: 1 - stat.get('memory.used', 0) / max(stat.get('memory.total', 0), 1)
+  return sum(gpu_id in killed and 1 or free_ratio(stats.get(gpu_id, {})) for gpu_id in gpu_ids) / len(gpu_ids)
+
+@placement_policy('fairshare')
+def fairshare_policy(index:AllocIndex, hostname:str, gpu_ids:tuple, killed:tuple) -> float:
+  # prefer to preempt users of lower priority, ie. those most beyond their fair share
+  if not killed: return 1
+  return 1 - sum(index.victim_priority(hostname, gpu_id) for gpu_id in killed) / len(killed)
+
+@placement_policy('idle')
+def idle_policy(index:AllocIndex, hostname:str, gpu_ids:tuple, killed:tuple) -> float:
+  # prefer cards with lower utilization
+  stats = gpu_stats.get(hostname, {})
+  idle_ratio = lambda stat: 1 - (stat.get('utilization.gpu') or 0) / 100
+  return sum(gpu_id in killed and 1 or idle_ratio(stats.get(gpu_id, {})) for gpu_id in gpu_ids) / len(gpu_ids)
+
+class Placement:
+
+  def __init__(self, index:AllocIndex):
+    self.index = index
+    self.policies = [(placement_policies[name], weight) for name, weight in PLACEMENT_POLICIES]
+
+  def score(self, hostname:str, gpu_ids:tuple, killed:tuple) -> float:
+    return sum(weight * fn(self.index, hostname, gpu_ids, killed) for fn, weight in self.policies)
+
+  @staticmethod
+  def _combos(gpu_ids:list, k:int):
+    # all k-combinations if not too many, otherwise random ones of them
+    if comb(len(gpu_ids), k) <= PLACEMENT_MAX_COMBOS:
+      yield from combinations(sorted(gpu_ids), k)
+    else:
+      for _ in range(PLACEMENT_MAX_COMBOS):
+        yield tuple(sorted(sample(gpu_ids, k)))
+
+  def place(self, gpu_count:int, with_kill:bool=False, priority:float=None) -> Tuple[str, list, list]:
+    ''' the best scored (hostname, gpu_ids, to_kill_gpu_ids) among candidate hosts, or None
+        to kill on only cards whose users are all of lower priority than `priority`, if given '''
+
+    best, best_score = None, None
+    for hostname in self.index.candidates(gpu_count, with_kill, PLACEMENT_MAX_HOSTS, priority):
+      free = sorted(self.index.free[hostname])
+      if len(free) >= gpu_count:
+        cands = ((gpu_ids, ()) for gpu_ids in self._combos(free, gpu_count))
+      else:   # take all free ones, plus some to kill on
+        killable = sorted(self.index.killable[hostname] if priority is None else self.index.killable_below(hostname, priority))
+        cands = ((tuple(sorted(free + list(killed))), killed) for killed in self._combos(killable, gpu_count - len(free)))
+
+      for gpu_ids, killed in cands:
+        score = self.score(hostname, gpu_ids, killed)
+        if best_score is None or score > best_score:
+          best, best_score = (hostname, list(gpu_ids), list(killed)), score
+    return best
+
+LACK_OF_RESOURCE = 'lack of resource'
+
+class ReallocJob:
+
+  def __init__(self, username:str, password:str, gpu_count:int, queue_timeout:float=0):
+    self.id        = uuid4().hex
+    self.username  = username
+    self.password  = password     # NOTE: dropped once the job finishes
+    self.gpu_count = gpu_count
+    self.state     = 'queued'     # 'queued' -> 'running' (<-> 'waiting' for GPUs to free up) -> 'done' | 'failed'
+    self.progress  = [ ]          # ['message'], what has been done
+    self.result    = None         # {'hostname', 'gpu_ids', 'killed'}, when 'done'
+    self.reason    = None         # str, when 'failed'
+    self.create_ts = now_ts()
+    self.finish_ts = None
+    self.deadline_ts = self.create_ts + queue_timeout   # keep waiting till then on lack of resource
+
+  @property
+  def finished(self) -> bool:
+    return self.state in ['done', 'failed']
+
+  def to_dict(self) -> dict:
+    return {k: getattr(self, k) for k in ['id', 'username', 'gpu_count', 'state', 'progress', 'result', 'reason', 'create_ts', 'finish_ts', 'deadline_ts']}
+
+class ReallocScheduler:
+
+  def __init__(self, monitor:'GpuMonitor'):
+    self.monitor  = monitor
+    self.jobs     = { }           # {'job_id': ReallocJob}
+    self.cond     = Condition()   # notified on any job update
+    self.executor = ThreadPoolExecutor(max_workers=REALLOC_WORKERS, thread_name_prefix='realloc')
+    self.waiting  = [ ]           # [ReallocJob], retried in order of priority after each sync
+    self.draining = Lock()        # one retry round at a time
+
+  def stop(self):
+    self.executor.shutdown(wait=False, cancel_futures=True)
+
+  def submit(self, username:str, password:str, gpu_count:int, queue_timeout:float=0) -> ReallocJob:
+    job = ReallocJob(username, password, gpu_count, queue_timeout)
+    with self.cond:
+      # forget those finished long ago
+      expired = [k for k, v in self.jobs.items() if v.finished and job.create_ts - v.finish_ts > REALLOC_JOB_TTL]
+      for k in expired: del self.jobs[k]
+      self.jobs[job.id] = job
+
+    logger.info(f'[realloc] job {job.id} queued: user {username!r} for {gpu_count} GPU(s)')
+    self.executor.submit(self._run, job)
+    return job
+
+  def get(self, job_id:str) -> ReallocJob:
+    return self.jobs.get(job_id)
+
+  def wait(self, job:ReallocJob, since:int, timeout:float) -> bool:
+    # block until the job makes progress beyond `since` steps, or finishes, or timeout
+    with self.cond:
+      return self.cond.wait_for(lambda: job.finished or len(job.progress) > since, timeout)
+
+  def _update(self, job:ReallocJob, msg:str=None, **kwargs):
+    with self.cond:
+      if msg: job.progress.append(msg)
+      for k, v in kwargs.items(): setattr(job, k, v)
+      if job.finished:
+        job.finish_ts = now_ts()
+        job.password = None
+        REALLOC_SECONDS.observe(job.finish_ts - job.create_ts, job.state)
+      self.cond.notify_all()
+
+  def _run(self, job:ReallocJob, retry:bool=False):
+    self._update(job, state='running')
+    try:
+      r = self.monitor.alloc_gpu(job.username, job.password, job.gpu_count, progress=lambda msg: self._update(job, msg), retry=retry)
+      if r == LACK_OF_RESOURCE and now_ts() < job.deadline_ts:
+        if not retry:
+          self._update(job, f'waiting in queue for GPUs to free up, till {datetime.fromtimestamp(job.deadline_ts):%Y-%m-%d %H:%M:%S}')
+        self._update(job, state='waiting')
+        with self.cond: self.waiting.append(job)
+        return
+      if type(r) == str: self._update(job, state='failed', reason=r)
+      else:              self._update(job, state='done', result=r)
+    except Exception as e:
+      logger.error(format_exc())
+      self._update(job, state='failed', reason=f'server internal error: {e}')
+    logger.info(f'[realloc] job {job.id} {job.state}')
+
+  def kick(self):
+    # NOTE: call after each sync, when GPUs may have freed up or priorities changed
+    if self.waiting: self.executor.submit(self._drain)
+
+  def _drain(self):
+    if not self.draining.acquire(blocking=False): return   # another round is on it, next sync would kick again
+    try:
+      with self.cond:
+        jobs, self.waiting = self.waiting, [ ]
+      # higher priority first, first come first served among equals
+      # NOTE: a lower one may still be served if what it asks fits in what the higher ones cannot use
+      priority = self.monitor.fairshare.priority
+      jobs.sort(key=lambda job: (-priority.get(job.username, 0), job.create_ts))
+      for job in jobs:
+        if now_ts() < job.deadline_ts:
+          self._run(job, retry=True)
+        else:
+          self._update(job, state='failed', reason=f'{LACK_OF_RESOURCE}, timeout in queue')
+          logger.info(f'[realloc] job {job.id} {job.state}')
+    finally:
+      self.draining.release()
+
+class PollScheduler:
+
+  ''' next-poll deadlines of hosts in a heap, polling often where a change is going on or coming, less on stable or unreachable ones '''
+
+  def __init__(self, monitor:'GpuMonitor'):
+    self.monitor  = monitor
+    self.heap     = [ ]     # [(deadline_ts, sock)], with outdated entries skipped on pop
+    self.deadline = { }     # {sock: deadline_ts}, of those scheduled
+    self.interval = { }     # {sock: seconds}, current poll interval
+    self.lock     = Lock()
+    with self.lock:
+      for sock in TRACKED_SOCKETS:
+        self._schedule(sock, 0)
+
+  @staticmethod
+  def bounds() -> Tuple[float, float]:
+    # NOTE: never beyond ACCOUNT_MAX_GAP, or the time held in between would be cut off from the charge
+    return min_to_sec(POLL_INTERVAL_MIN), min_to_sec(min(POLL_INTERVAL_MAX, ACCOUNT_MAX_GAP))
+
+  def _schedule(self, sock:Tuple[str, int], interval:float):
+    # NOTE: call with `self.lock` held
+    self.deadline[sock] = deadline_ts = now_ts() + interval
+    heappush(self.heap, (deadline_ts, sock))
+
+  def _peek(self) -> tuple:
+    # NOTE: call with `self.lock` held
+    while self.heap and self.deadline.get(self.heap[0][1]) != self.heap[0][0]:
+      heappop(self.heap)
+    return self.heap and self.heap[0] or None
+
+  def due(self) -> list:
+    ''' take out the hosts due by now, and those due soon so that they share one fan-out '''
+
+    limit = now_ts() + min_to_sec(POLL_INTERVAL_MIN) / 2
+    socks = [ ]
+    with self.lock:
+      while (top := self._peek()) and top[0] <= limit:
+        heappop(self.heap)
+        del self.deadline[top[1]]
+        socks.append(top[1])
+    return socks
+
+  def next_ts(self) -> float:
+    with self.lock:
+      top = self._peek()
+      return top and top[0]
+
+  def requeue(self, socks:list):
+    # those taken out but not rescheduled by `adapt()` (eg. sync crashed), keep their interval
+    with self.lock:
+      for sock in socks:
+        if sock not in self.deadline:
+          self._schedule(sock, self.interval.get(sock, min_to_sec(AUTO_SYNC_INTERVAL)))
+
+  def adapt(self, polled:dict, changed:set):
+    ''' reschedule the hosts just polled, `polled` is {sock: 'hostname'} (None if failed), `changed` are socks whose occupancy changed '''
+
+    lo, hi = self.bounds()
+    # a change is coming on hosts with cards handed out but not taken yet, or killable by some job waiting in queue
+    priority = self.monitor.fairshare.priority
+    top = max((priority.get(job.username, 0) - FAIRSHARE_MARGIN for job in list(self.monitor.realloc.waiting)), default=None)
+    with index_lock:
+      index = self.monitor.alloc_index
+      reserved = {hostname for (hostname, _), expire_ts in index.reserved.items() if expire_ts > now_ts()}
+      hot = {hostname for hostname in polled.values() if hostname in reserved
+              or (top is not None and hostname in index.blocks and index.killable_below(hostname, top))}
+
+    with self.lock:
+      for sock, hostname in polled.items():
+        interval = self.interval.get(sock, min_to_sec(AUTO_SYNC_INTERVAL))
+        if sock in changed or hostname in hot: interval = lo
+        else:                                  interval *= POLL_BACKOFF    # stable or unreachable, back off
+        self.interval[sock] = interval = min(max(interval, lo), hi)
+        self._schedule(sock, interval)
 
 class GpuMonitor:
 
   def __init__(self):
     # workers
     self.quota_tracker = QuotaTracker()
-    self.ssh_pool      = SshPool()
-    self.check_timer   = Timer(1, self.dequota_task)
+    self.accountant    = UsageAccountant()
+    self.alloc_index   = AllocIndex()
+    self.placement     = Placement(self.alloc_index)
+    self.quota_gen     = None    # `quota_tracker.generation` that `fairshare` is seeded from
+    self.backend       = host_backends[HOST_BACKEND]()
+    self.check_timer   = new_timer(0, self.dequota_task)
+    self.checkpoint_timer = new_timer(CHECKPOINT_INTERVAL, self.checkpoint_task)
+    self.watch_timer   = new_timer(QUOTA_WATCH_INTERVAL, self.watch_task)
+    self.rules_mtime   = None    # of QUOTA_INIT_FILE, as of last (re)load
+    self.seen_mtime    = None    # of QUOTA_INIT_FILE, as of last watch, see `watch_task()`
+    self.poller        = PollScheduler(self)
+    self.sync_pool     = ThreadPoolExecutor(max_workers=SYNC_WORKERS, thread_name_prefix='sync')
+    self.realloc       = ReallocScheduler(self)
+    self.auth          = AuthVerifier()
+    self.fairshare     = FairShare()    # NOTE: guarded by `quota_lock`
+    self.history       = HISTORY_PATH and HistoryStore()
+    self.report        = UsageReport(self.quota_tracker, self.fairshare, self.history)
+    self.kill_locks    = defaultdict(Lock)   # {'hostname': Lock}, one preemption per host at a time
 
     # limit `.sync()` call frequency
     self.last_sync_ts = now_ts()
 
+    # hosts restored from the checkpoint and not refreshed yet, see `restore()`
+    self.stale = { }    # {'hostname': ts}, when it was last observed
+
+    # hosts whose topology query failed, see `_query_topology()`
+    self.topo_retry = { }   # {'hostname': (retry_ts, backoff)}
+
+    # as a shard, see `report_to_aggregator()`
+    self.shard_epoch = uuid4().hex    # tells the aggregator we've restarted, and seq starts over
+    self.shard_seq   = 0
+    self.unacked     = [ ]            # [(seq, {'username': time_in_hour})], usage batches not acked by the aggregator
+    self.shard_lock  = Lock()
+
   def start(self):
+    if (SHARD_AGGREGATOR or HOST_BACKEND == 'shard') and not SHARD_SECRET:
+      logger.warning('[start] SHARD_SECRET not set, requests among shards & aggregator will be refused')
     self.quota_tracker.start()
+    if CHECKPOINT_FILE: self.restore()
+    self.publish()
+    self.backend.start()
     self.check_timer.start()
+    if CHECKPOINT_FILE: self.checkpoint_timer.start()
+    self.rules_mtime = self._get_rules_mtime()
+    if QUOTA_WATCH_INTERVAL: self.watch_timer.start()
 
   def stop(self):
     self.check_timer.cancel()
-    self.ssh_pool.destroy()
+    self.checkpoint_timer.cancel()
+    self.watch_timer.cancel()
+    if CHECKPOINT_FILE: self.checkpoint()
+    self.realloc.stop()
+    self.sync_pool.shutdown(wait=False, cancel_futures=True)
+    self.backend.stop()
     self.quota_tracker.stop()
 
-  def query_quota(self, username=None) -> dict:
-    r = self.quota_tracker.query()
-    if username:
-      if username in r: return {username: r[username]}
-      else: return None
-    else:
-      return r
+  def publish(self):
+    # NOTE: call after each update of `gpu_runtime` or quota
+    with publish_lock:
+      with quota_lock:
+        quotas = dict(self.quota_tracker.query())
+        if self.quota_gen != self.quota_tracker.generation:     # reloaded, start over
+          self.quota_gen = self.quota_tracker.generation
+          self.fairshare.seed(self.quota_tracker.allotment, quotas)
+        priority = self.fairshare.compute(self.quota_tracker.allotment, quotas)
+      with index_lock:
+        self.alloc_index.update_priority(priority)
+
+      runtime = gpu_runtime.to_serializable()
+
+      # NOTE: the stale ones are told along with 'data', to keep its shape
+      stale = dict(self.stale)
+      publish_snapshot('runtime', runtime, **(stale and {'stale': stale} or { }))
+      publish_snapshot('quota', quotas)
+      # more to select by `?fields` of `/runtime` & `/quota`, NOTE: cards' stats are replaced rather than updated in place
+      publish_snapshot('stats', {hostname: dict(gpu_stat) for hostname, gpu_stat in list(gpu_stats.items())})
+      allotment = self.quota_tracker.allotment
+      publish_snapshot('quota_detail', {username: {
+        'remnant': remnant,
+        'allotment': allotment.get(username),
+        'used': allotment[username] - remnant if username in allotment else None,
+        'priority': priority.get(username, 0),
+      } for username, remnant in quotas.items()})
+
+  def _get_checkpoint_fp(self) -> str:
+    return os.path.join(BASE_PATH, DATA_PATH, CHECKPOINT_FILE)
+
+  def checkpoint(self):
+    ''' save runtime states of all hosts, to serve right away on restart '''
+
+    hosts = { }
+    runtime = gpu_runtime.to_serializable()
+    for hostname, gpu_rt in runtime.items():
+      with host_lock(hostname):
+        if hostname not in gpu_runtime or hostname not in host_resolv: continue
+        hosts[hostname] = {
+          'sock': host_resolv[hostname],
+          'ts': self.accountant.last_ts.get(hostname) or self.stale.get(hostname),
+          'gpus': gpu_rt,
+          'stats': gpu_stats[hostname],
+          'topology': [[i, j, score] for (i, j), score in gpu_topology.get(hostname, {}).items()],
+        }
+
+    fp = self._get_checkpoint_fp()
+    with open(fp + '.tmp', 'w', encoding='utf8') as fh:
+      fh.write(dumps({'ts': now_ts(), 'hosts': hosts}))
+    os.replace(fp + '.tmp', fp)
+
+  def restore(self):
+    ''' load the checkpoint, as stale ones till each host is synced again '''
+
+    fp = self._get_checkpoint_fp()
+    if not os.path.exists(fp): return
+    try:
+      with open(fp, 'r', encoding='utf8') as fh:
+        state = loads(fh.read())
+    except Exception as e:
+      logger.warning(f'[restore] bad checkpoint {fp!r}: {e!r}, ignored')
+      return
+    age = now_ts() - state['ts']
+    if age > min_to_sec(CHECKPOINT_MAX_AGE):
+      logger.info(f'[restore] checkpoint {fp!r} too old ({age:.0f}s), ignored')
+      return
+
+    # NOTE: the accountant starts over, the interval since the last observation before restart is not charged,
+    # the checkpoint might be older than what has been charged already
+    tracked = set(TRACKED_SOCKETS)
+    for hostname, host in state['hosts'].items():
+      sock = tuple(host['sock'])
+      if sock not in tracked: continue
+      with host_lock(hostname):
+        host_resolv[hostname] = sock
+        gpu_runtime[hostname] = {int(gpu_id): set(users) for gpu_id, users in host['gpus'].items()}
+        gpu_stats[hostname] = gpu_stat = {int(gpu_id): stat for gpu_id, stat in host['stats'].items()}
+        if host['topology']:
+          gpu_topology[hostname] = {(i, j): score for i, j, score in host['topology']}
+        with index_lock:
+          self.alloc_index.update_host(hostname, *gpu_runtime.block(hostname), dict(gpu_stat), stale=True)
+        self.stale[hostname] = host['ts'] or state['ts']
+    logger.info(f'[restore] {len(self.stale)} host(s) from checkpoint of {age:.0f}s ago')
+
+  def checkpoint_task(self):
+    # reset timer
+    self.checkpoint_timer = new_timer(CHECKPOINT_INTERVAL, self.checkpoint_task)
+    self.checkpoint_timer.start()
+
+    # do work
+    self.checkpoint()
 
-  @perf_counter
   def try_sync(self) -> bool:
     if now_ts() - self.last_sync_ts < FORCE_SYNC_DEADTIME:
       return False
@@ -311,135 +2332,452 @@ class GpuMonitor:
     self.last_sync_ts = now_ts()
     return True
 
-  @with_lock(lock)
-  def sync(self) -> DefaultDict:
-    quota_portion = defaultdict(int)     # {'username': portion(int)}
-    for sock in TRACKED_SOCKETS:         # foreach host
-      logger.info(f'  >> query {sock_to_hostport(sock)}')
+  def _query_host(self, sock:Tuple[str, int]) -> dict:
+    logger.info(f'  >> query {sock_to_hostport(sock)}')
 
-      try:
-        ssh = self.ssh_pool.get(sock)
-  
-        # NOTE: dict key 'queyr_time' should be removed, cos' type `datetime` is not JSON serializable
-        # but `del['queyr_time']` does NOT work due to some `eval()` function closure issues, so we keep this `pop()[1]` magic :)
-        py_cmd = 'import gpustat, json; r = gpustat.new_query().jsonify(); r.pop(list(r.keys())[1]); print(json.dumps(r))'
-        sh_cmd = f'python -c "{py_cmd}"'
-        stdin, stdout, stderr = ssh.exec_command(sh_cmd, timeout=SSH_TIMEOUT)
-        res = loads(stdout.read().strip())
-
-        hostname = res['hostname']
-        if hostname not in host_resolv:
-          host_resolv[hostname] = sock
-
-        gpu_rt = gpu_runtime[hostname]    # {0: {username}}
-        for gpu in res['gpus']:           # foreach GPU
-          gpu_id, procs = gpu['index'], gpu['processes']
-          gpu_rt[gpu_id] = {p['username'] for p in procs}     # dedup users on a single card
-
-          for username in gpu_rt[gpu_id]:
-            quota_portion[username] += 1
-
-      except Exception:
-        for k, v in host_resolv.items():    # temporarily forget it
-          if v == sock and k in gpu_runtime:
-            gpu_runtime.pop(k)
-            break
-        self.ssh_pool.mark_broken(ssh)
+    start = monotonic()
+    try:
+      return self.backend.query(sock)
+    finally:
+      SSH_QUERY_SECONDS.observe(monotonic() - start, sock_to_hostport(sock))
+
+  def _query_topology(self, sock:Tuple[str, int], hostname:str):
+    try:
+      gpu_topology[hostname] = parse_topology(self.backend.topology(sock))
+      self.topo_retry.pop(hostname, None)
+    except Exception as e:
+      # keep it unknown, and retry later with backoff rather than on every sync
+      backoff = min(max(self.topo_retry.get(hostname, (0, 0))[1] * 2, TOPO_RETRY[0]), TOPO_RETRY[1])
+      self.topo_retry[hostname] = (now_ts() + backoff, backoff)
+      logger.warning(f'  << query topology failed for {sock_to_hostport(sock)}: {e!r}, retry in {backoff}s')
+
+  @perf_counter(SYNC_SECONDS)
+  def sync(self, socks:list=None) -> dict:
+    # fan out to the hosts (all if not given) concurrently, each bounded by SSH_TIMEOUT, all bounded by SYNC_DEADLINE
+    # NOTE: wall time is about the slowest healthy host, rather than sum over all hosts
+    if socks is None: socks = TRACKED_SOCKETS
+    if HOST_BACKEND == 'shard': socks = [ ]    # hosts are polled by the shards owning them, see `absorb()`
+    futures = {self.sync_pool.submit(self._query_host, sock): sock for sock in socks}
+    done, _ = wait(futures, timeout=SYNC_DEADLINE)
+
+    results, failed = { }, [ ]
+    for fut, sock in futures.items():
+      if fut in done and fut.exception() is None:
+        results[sock] = fut.result()
+      else:
+        fut.cancel()
+        failed.append(sock)
         logger.error(f'  << failed for {sock_to_hostport(sock)}')
 
-    return quota_portion
+    # merge the results host by host, each under its own lock
+    # and charge each user for the actual elapsed time since last observation of each host
+    usage = np.zeros(0)                  # time_in_hour by user id
+    merged = [ ]                         # [res], with 'sock' & 'dt', to report if we're a shard
+    changed = set()                      # {sock}, whose occupancy changed
+    for sock, res in results.items():    # foreach host
+      hostname = res['hostname']
+      with host_lock(hostname):
+        if not self.accountant.is_newer(hostname, res['query_ts']):
+          continue                        # a concurrent sync has already merged a later one
+        dt = self.accountant.elapsed(hostname, res['query_ts'])
+        _, block = self._merge_host(sock, res, dt)
+        if self.accountant.differs(hostname, block): changed.add(sock)
+        portion = self.accountant.observe(hostname, block, res['query_ts'])
+        usage = pad_to(usage, len(portion))
+        usage[:len(portion)] += portion
+      if SHARD_AGGREGATOR: merged.append(dict(res, sock=sock, dt=dt))
+    usage = gpu_runtime.to_names(usage)  # {'username': time_in_hour}
+    polled = {sock: None for sock in failed} | {sock: res['hostname'] for sock, res in results.items()}
+
+    if HOST_BACKEND == 'shard':          # hosts behind a shard gone silent
+      failed += self.backend.stale()
+    lost = [k for k, v in list(host_resolv.items()) if v in failed]
+    for hostname in lost:                # temporarily forget it
+      self._forget_host(hostname)
+
+    if self.history: self.history.flush()
+
+    if SHARD_AGGREGATOR:                 # the ledger lives in the aggregator
+      self.report_to_aggregator(merged, lost, usage)
+      self.publish()
+    else:
+      self.settle(usage)
+
+    self.poller.adapt(polled, changed)
+    return usage
+
+  def _merge_host(self, sock:Tuple[str, int], res:dict, dt:float) -> Tuple[np.ndarray, np.ndarray]:
+    # NOTE: call with `host_lock(hostname)` held, returns `gpu_runtime.block(hostname)`
+    hostname = res['hostname']
+    if hostname not in host_resolv:
+      host_resolv[hostname] = sock
+    self.stale.pop(hostname, None)
+
+    gpu_rt = { }                      # {0: {username}}
+    gpu_stat = gpu_stats[hostname]    # {0: {'memory.used': int, ...}}
+    for gpu in res['gpus']:           # foreach GPU
+      gpu_id, procs = gpu['index'], gpu['processes']
+      gpu_rt[gpu_id] = {p['username'] for p in procs}     # dedup users on a single card
+      gpu_stat[gpu_id] = {k: gpu.get(k) or 0 for k in ['memory.used', 'memory.total', 'utilization.gpu']}   # NOTE: may be None if N/A
+    gpu_runtime[hostname] = gpu_rt
+    gpu_ids, block = gpu_runtime.block(hostname)
+
+    if self.history:
+      self.history.record(hostname, gpu_rt, gpu_stat, res['query_ts'], dt)
+    with index_lock:
+      self.alloc_index.update_host(hostname, gpu_ids, block, dict(gpu_stat))
+
+    retry_ts, backoff = self.topo_retry.get(hostname, (None, 0))
+    if hostname not in gpu_topology or (retry_ts and retry_ts <= now_ts()):  # fetch once in background, it hardly changes
+      gpu_topology.setdefault(hostname, { })
+      if retry_ts: self.topo_retry[hostname] = (None, backoff)    # in flight
+      self.sync_pool.submit(self._query_topology, sock, hostname)
+    return gpu_ids, block
+
+  def _forget_host(self, hostname:str):
+    with host_lock(hostname):
+      gpu_runtime.pop(hostname, None)
+      gpu_stats.pop(hostname, None)
+      self.stale.pop(hostname, None)
+      self.accountant.forget(hostname)
+      with index_lock:
+        self.alloc_index.remove_host(hostname)
+
+  def settle(self, usage:dict, ack:tuple=None):
+    # charge the usage to the ledger, then let everyone know, `ack` is (shard, epoch, seq) of the usage batches from a shard
+    with quota_lock:
+      if usage:
+        # NOTE: we move this log out of `QuotaTracker.dequota` for pretty printing :)
+        logger.info('[dequota]')
+        for username, time_in_hour in usage.items():
+          self.quota_tracker.dequota(username, time_in_hour)
+      if ack: self.quota_tracker.ack(*ack)    # NOTE: in the same commit with the usage
+      self.quota_tracker.commit()
+      self.fairshare.charge(usage)
+
+    self.publish()
+    self.realloc.kick()
+
+  def report_to_aggregator(self, merged:list, lost:list, usage:dict):
+    # NOTE: usage batches are resent till acked, and applied once by seq, so none lost or double charged
+    with self.shard_lock:
+      if usage:
+        self.shard_seq += 1
+        self.unacked.append((self.shard_seq, dict(usage)))
+      hosts = [{
+        'hostname': res['hostname'],
+        'sock': res['sock'],
+        'query_ts': res['query_ts'],
+        'dt': res['dt'],
+        'gpus': [dict({k: gpu.get(k) for k in ['index', 'memory.used', 'memory.total', 'utilization.gpu']},
+                      processes=[{'username': p['username']} for p in gpu['processes']]) for gpu in res['gpus']],
+      } for res in merged]
+      report = {'shard': SHARD_URL, 'epoch': self.shard_epoch, 'hosts': hosts, 'lost': lost, 'usage': self.unacked}
+      try:
+        acked = http_call(f'{SHARD_AGGREGATOR}/shard/report', report)['acked']
+        self.unacked = [batch for batch in self.unacked if batch[0] > acked]
+      except Exception as e:
+        logger.warning(f'[report] to {SHARD_AGGREGATOR} failed: {e!r}, {len(self.unacked)} usage batch(es) pending')
+
+  def absorb(self, report:dict) -> int:
+    ''' merge a report from a shard, returns seq of the last usage batch applied '''
+
+    shard, epoch = report['shard'], report['epoch']
+    self.backend.seen(shard)
+    for res in report['hosts']:
+      sock, hostname = tuple(res['sock']), res['hostname']
+      with host_lock(hostname):
+        if not self.backend.is_newer(hostname, res['query_ts']): continue
+        self.backend.own(sock, hostname, shard, res['query_ts'])
+        self._merge_host(sock, res, res['dt'])
+    for hostname in report['lost']:
+      self._forget_host(hostname)
+    if self.history: self.history.flush()
+
+    # NOTE: the seq applied is kept along with the ledger, so a batch resent after we restart is not charged again
+    usage = defaultdict(float)
+    with quota_lock:
+      acked = last = self.quota_tracker.acked.get((shard, epoch), 0)
+      for seq, batch in report['usage']:
+        if seq <= last: continue
+        for username, time_in_hour in batch.items():
+          usage[username] += time_in_hour
+        last = seq
+      self.quota_tracker.acked[(shard, epoch)] = last    # keep a concurrent report off these batches
+    self.settle(usage, last > acked and (shard, epoch, last) or None)
+    return last
 
-  @perf_counter
   def dequota_task(self):
-    logger.info('[dequota_task]')
+    # do work: poll the hosts due, see `PollScheduler`
+    # NOTE: `sync()` charges by the actual elapsed time of each host, so any poll rate per host, or any other sync in between, is fine
+    socks = self.poller.due()
+    try:
+      if socks or HOST_BACKEND == 'shard':    # the latter to expire hosts of silent shards
+        logger.info(f'[dequota_task] {len(socks)} host(s) due')
+        self.sync(socks)
+    finally:
+      self.poller.requeue(socks)
+
+      # reset timer, till the next host is due, or on the aggregator, till the hosts of a shard are to expire
+      next_ts = HOST_BACKEND == 'shard' and self.backend.next_ts() or self.poller.next_ts()
+      delay = min_to_sec(AUTO_SYNC_INTERVAL)
+      if next_ts: delay = min(max(next_ts - now_ts(), 0), delay)
+      self.check_timer = new_timer(delay, self.dequota_task)
+      self.check_timer.start()
+
+  def _get_rules_mtime(self) -> int:
+    try:    return os.stat(os.path.join(BASE_PATH, QUOTA_INIT_FILE)).st_mtime_ns
+    except FileNotFoundError: return None
+
+  def reload_quota(self) -> dict:
+    self.rules_mtime = self._get_rules_mtime()
+    diff = self.quota_tracker.reload()
+    if any(diff.values()):
+      self.publish()
+      self.realloc.kick()     # priorities may have changed
+    return diff
+
+  def adjust_quota(self, deltas:dict, reason:str=None) -> dict:
+    logger.info(f'[adjust_quota] {len(deltas)} user(s), for {reason!r}')
+    r = self.quota_tracker.adjust(deltas)
+    self.publish()
+    self.realloc.kick()
+    return r
 
+  def watch_task(self):
     # reset timer
-    self.check_timer = Timer(min_to_sec(AUTO_SYNC_INTERVAL), self.dequota_task)
-    self.check_timer.start()
+    self.watch_timer = new_timer(QUOTA_WATCH_INTERVAL, self.watch_task)
+    self.watch_timer.start()
 
-    # do work
-    quota_portion = self.sync()
-    if quota_portion:
-      # NOTE: we move this log out of `QuotaTracker.dequota` for pretty printing :)
-      logger.info('[dequota]')
-      for username, portion in quota_portion.items():
-        self.quota_tracker.dequota(username, min_to_hour(AUTO_SYNC_INTERVAL * portion))
-
-  def alloc_gpu(self, username, password, gpu_count) -> Union[str, list]:
+    # do work: reload once QUOTA_INIT_FILE is modified, and then left alone for a round, so not caught in the middle of a write
+    mtime, seen_mtime = self._get_rules_mtime(), self.seen_mtime
+    self.seen_mtime = mtime
+    if mtime not in [self.rules_mtime, None] and mtime == seen_mtime:
+      self.reload_quota()
+
+  def kill_gpus(self, sock:Tuple[str, int], gpu_ids:list) -> list:
+    ''' kill all processes on `gpu_ids` of the host, returns [{'pid', 'username', 'command', 'gpu', 'result'}] '''
+
+    logger.info('[kill]')
+
+    procs = self.backend.kill(sock, gpu_ids)
+    for proc in procs:
+      logger.info(f'  >> [{proc["username"]}] {proc["pid"]}: {proc["command"]} ({proc["result"]})')
+      KILLED_PROCESSES.inc(sock_to_hostport(sock), proc['result'])
+    return procs
+
+  def alloc_gpu(self, username, password, gpu_count, progress=None, retry=False) -> Union[str, dict]:
     logger.info('[alloc_gpu]')
+    progress = progress or (lambda msg: None)
+    lookup = retry and (lambda msg: None) or progress   # NOTE: keep a waiting job's progress from flooding
 
     # try alloc current free
-    free_map = {hostname: {gpu_id for gpu_id, users in gpu_rt.items() 
-                                  if not len(users)}
-                for hostname, gpu_rt in gpu_runtime.items()}
-    hostnames = list(free_map.keys()); shuffle(hostnames)
-    for hostname in hostnames:
-      free_gpu_ids = list(free_map[hostname])
-      if len(free_gpu_ids) >= gpu_count:
-        return {
-          'hostname': hostname,
-          'gpu_ids': sorted(sample(free_gpu_ids, gpu_count))
-        }
+    lookup('looking for free GPUs')
+    with index_lock:
+      r = self.placement.place(gpu_count)
+      if r: self.alloc_index.reserve(r[0], r[1])
+    if r:
+      hostname, gpu_ids, _ = r
+      return {
+        'hostname': hostname,
+        'gpu_ids': gpu_ids
+      }
 
     # check quota of requester
     quotas = self.quota_tracker.query()
     if username in quotas and quotas[username] < 0:
       return 'you have run out of quota'
 
-    # try alloc with kill
-    all_killable = lambda users: not [True for user in users if user in quotas and quotas[user] > 0]
-    killable_map = {hostname: {gpu_id for gpu_id, users in gpu_rt.items()
-                                      if (gpu_id not in free_map[hostname]) and all_killable(users)}
-                    for hostname, gpu_rt in gpu_runtime.items()}
-    hostnames = list(killable_map.keys()); shuffle(hostnames)
-    for hostname in hostnames:
-      if len(free_map[hostname]) + len(killable_map[hostname]) >= gpu_count:
-        sock = host_resolv[hostname]
-
-        # check authentication
-        r = SshPool.test_login(sock, username, password)
-        if r is False:  return 'linux auth failed, wrong username/password'
-        elif r is None: return 'server internal error: ssh connect failed'
-
-        # decide which to sacrifice with randomness
-        free_gpu_ids      = list(free_map[hostname])
-        killable_gpu_ids  = list(killable_map[hostname])
-        to_kill_cnt       = gpu_count - len(free_gpu_ids)
-        to_kill_gpu_ids   = sample(killable_gpu_ids, to_kill_cnt)
-
-        # gogogo!
-        logger.info('[kill]')
-        try:
-          ssh = self.ssh_pool.get(sock)
-          py_cmd = 'import gpustat, json; r = gpustat.new_query().jsonify(); r.pop(list(r.keys())[1]); print(json.dumps(r))'
-          sh_cmd = f'python -c "{py_cmd}"'
-          stdin, stdout, stderr = ssh.exec_command(sh_cmd, timeout=SSH_TIMEOUT)
-          res = loads(stdout.read().strip())
-
-          for gpu in res['gpus']:           # foreach GPU
-            gpu_id = gpu['index']
-            if gpu_id not in to_kill_gpu_ids: continue
-            for proc in gpu['processes']:
-              pid = proc['pid']
-              logger.info(f'  >> [{proc["username"]}] {pid}: {proc["command"]}')
-
-              sh_cmd = f'kill -9 {pid}'
-              stdin, stdout, stderr = ssh.exec_command(sh_cmd, timeout=SSH_TIMEOUT)
-              _ = stdout.read()              # may us assert _ is ''
-
-        except Exception as e:
-          logger.error(format_exc())
-          return f'server internal error: {e}'
-        
-        # instantly make a sync
-        Timer(0, self.sync).start()
-        # tell client
-        return {
-          'hostname': hostname,
-          'gpu_ids': sorted(free_gpu_ids + to_kill_gpu_ids)
-        }
+    # try alloc with kill, on those of lower priority only
+    lookup('looking for GPUs to preempt')
+    priority = self.fairshare.priority.get(username, 0) - FAIRSHARE_MARGIN
+    with index_lock:
+      r = self.placement.place(gpu_count, with_kill=True, priority=priority)
+      if r: self.alloc_index.reserve(r[0], r[1])
+    if not r: return LACK_OF_RESOURCE
+    hostname, gpu_ids, to_kill_gpu_ids = r
+
+    # NOTE: from now on, give the reserved cards back on any failure
+    r = self._preempt(username, password, hostname, to_kill_gpu_ids, progress)
+    if type(r) == str:
+      with index_lock: self.alloc_index.release(hostname, gpu_ids)
+      return r
 
-    return 'lack of resource'
+    # instantly make a sync of the host
+    # NOTE: on the aggregator, the shard owning it does so right after the kill, see `shard_kill()`
+    if HOST_BACKEND != 'shard':
+      new_timer(0, lambda: self.sync([host_resolv[hostname]])).start()
+    # tell client
+    return {
+      'hostname': hostname,
+      'gpu_ids': gpu_ids,
+      'killed': r,
+    }
+
+  def _preempt(self, username, password, hostname, to_kill_gpu_ids, progress) -> Union[str, list]:
+    sock = host_resolv[hostname]
+
+    # check authentication
+    progress(f'checking linux auth of {username!r}')
+    r = self.auth.verify(sock, username, password)
+    if r is False:  return 'linux auth failed, wrong username/password'
+    elif r is None: return 'server internal error: ssh connect failed'
+
+    # gogogo!
+    progress(f'killing on {hostname}: {to_kill_gpu_ids}')
+    try:
+      with self.kill_locks[hostname]:
+        return self.kill_gpus(sock, to_kill_gpu_ids)
+    except Exception as e:
+      logger.error(format_exc())
+      return f'server internal error: {e}'
+
+def gpu_count_gauge(count):
+  def collect() -> dict:
+    with index_lock:
+      index = monitor.alloc_index
+      return {(hostname,): count(index, hostname) for hostname in index.blocks}
+  return collect
+
+Gauge('sodayo_gpus_total', 'GPUs on each host', ('host',), gpu_count_gauge(lambda index, h: len(index.blocks[h][0])))
+Gauge('sodayo_gpus_free', 'GPUs free to hand out on each host', ('host',), gpu_count_gauge(lambda index, h: len(index.free[h])))
+Gauge('sodayo_gpus_busy', 'GPUs with processes on each host', ('host',), gpu_count_gauge(lambda index, h: int(index.blocks[h][1].any(axis=1).sum())))
+Gauge('sodayo_host_up', 'Whether the ssh circuit of each host is closed', ('host',),
+      lambda: {(sock_to_hostport(sock),): int(health.state == 'up') for sock, health in list(monitor.backend.health.items())})
+Gauge('sodayo_host_consecutive_failures', 'Consecutive ssh failures of each host', ('host',),
+      lambda: {(sock_to_hostport(sock),): health.consecutive_failures for sock, health in list(monitor.backend.health.items())})
+Gauge('sodayo_ssh_pool_connections', 'Pooled ssh connections', (), lambda: {(): len(monitor.backend.ssh_pool.pool)})   # NOTE: none if not on ssh
+Gauge('sodayo_poll_interval_seconds', 'Current poll interval of each host', ('host',),
+      lambda: {(sock_to_hostport(sock),): interval for sock, interval in list(monitor.poller.interval.items())})
+Gauge('sodayo_realloc_waiting_jobs', 'Realloc jobs waiting for GPUs to free up', (), lambda: {(): len(monitor.realloc.waiting)})
+
+
+##############################################################################
+# serving
+
+# NOTE: with a multi-process server (eg. `gunicorn -w 4 -k gthread --threads 16 'sodayo:create_app()'`),
+# only one process, the leader elected by a file lock, runs `GpuMonitor` which owns sync & quota states,
+# the others (followers) mirror its published snapshots for `/runtime` & `/quota`, and forward the rest to it
+
+leader_lock_fh = None       # held by the leader till exit
+
+def try_lead() -> bool:
+  global leader_lock_fh
+
+  fh = open(os.path.join(BASE_PATH, LEADER_LOCK_FILE), 'a')
+  try:
+    fcntl.flock(fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+  except OSError:
+    fh.close()
+    return False
+  leader_lock_fh = fh
+  return True
+
+def lead(role:str):
+  global monitor, serving_role
+  logger.info(f'[lead] as {role} in process {os.getpid()}')
+
+  serving_role = role
+  if role == 'leader':
+    os.makedirs(os.path.join(BASE_PATH, STATE_PATH), exist_ok=True)
+    # an extra listener only for followers to forward to, NOTE: the public one is shared by all processes
+    host, port = LEADER_SOCKET
+    server = make_server(host, port, app, threaded=True)
+    Thread(target=server.serve_forever, name='leader', daemon=True).start()
+
+  monitor = GpuMonitor()
+  monitor.start()
+  atexit.register(monitor.stop)
+
+def mirror(mtimes:dict):
+  # load snapshots newly saved by the leader
+  for name in ['runtime', 'quota', 'stats', 'quota_detail']:
+    fp = os.path.join(BASE_PATH, STATE_PATH, f'{name}.json')
+    try:
+      mtime = os.stat(fp).st_mtime_ns
+      if mtimes.get(name) == mtime: continue
+      with open(fp, 'rb') as fh:
+        body = loads(fh.read())
+      mtimes[name] = mtime
+    except FileNotFoundError:
+      continue
+    with publish_lock:
+      publish_snapshot(name, body['data'], **{k: v for k, v in body.items() if k not in ['ok', 'data']})
+
+def follow():
+  # mirror the leader, and take over once it's gone
+  mtimes = { }    # {'name': st_mtime_ns}
+  while True:
+    try:
+      mirror(mtimes)
+    except Exception:
+      logger.error(format_exc())
+    if try_lead():
+      lead('leader')
+      return
+    sleep(MIRROR_INTERVAL)
+
+def forward_to_leader() -> Response:
+  host, port = LEADER_SOCKET
+  url = f'http://{host}:{port}{request.full_path.rstrip("?")}'
+  headers = {k: v for k, v in request.headers.items() if k.lower() in ['content-type', 'if-none-match', 'x-shard-secret', 'x-admin-secret']}
+  req = Request(url, data=request.get_data() or None, headers=headers, method=request.method)
+  try:
+    with urlopen(req, timeout=LONGPOLL_TIMEOUT + SYNC_DEADLINE) as resp:
+      status, resp_headers, body = resp.status, resp.headers, resp.read()
+  except HTTPError as e:      # NOTE: including 304
+    status, resp_headers, body = e.code, e.headers, e.read()
+  except Exception as e:
+    logger.error(f'[forward] {url} failed: {e!r}')
+    return RESPONSE.fail('leader not available, retry later')
+
+  r = Response(body, status, content_type=resp_headers.get('Content-Type'))
+  if resp_headers.get('ETag'): r.headers['ETag'] = resp_headers['ETag']
+  return r
+
+def leader_only(fn):
+  # routes needing states held by `monitor`, forwarded by followers
+  @wraps(fn)
+  def wrapper(*args, **kwargs):
+    if serving_role == 'follower': return forward_to_leader()
+    return fn(*args, **kwargs)
+  return wrapper
+
+def shard_only(role:str):
+  # routes among sodayo instances, served only as the 'aggregator' or a 'shard', guarded by SHARD_SECRET, disabled if not set
+  def decorator(fn):
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+      if role == 'aggregator' and HOST_BACKEND != 'shard' or role == 'shard' and not SHARD_AGGREGATOR:
+        return RESPONSE.fail(f'not a {role}'), 403
+      if not SHARD_SECRET or not hmac.compare_digest(request.headers.get('X-Shard-Secret', ''), SHARD_SECRET):
+        return RESPONSE.fail('shard secret mismatch'), 403
+      return fn(*args, **kwargs)
+    return wrapper
+  return decorator
+
+def admin_only(fn):
+  # routes changing the ledger, guarded by ADMIN_SECRET, disabled if not set
+  @wraps(fn)
+  def wrapper(*args, **kwargs):
+    if not ADMIN_SECRET or not hmac.compare_digest(request.headers.get('X-Admin-Secret', ''), ADMIN_SECRET):
+      return RESPONSE.fail('admin secret mismatch'), 403
+    return fn(*args, **kwargs)
+  return wrapper
+
+def create_app(standalone:bool=False) -> Flask:
+  ''' start serving in this process, the entry for WSGI servers '''
+
+  init_logger()
+  if standalone:  lead('standalone')
+  elif try_lead(): lead('leader')
+  else:
+    global serving_role
+    serving_role = 'follower'
+    logger.info(f'[follow] in process {os.getpid()}')
+    mirror({ })
+    Thread(target=follow, name='follower', daemon=True).start()
+  return app
 
 
 ##############################################################################
@@ -451,42 +2789,271 @@ def root():
   except: return 'Web service not available :('
 
 @app.route('/sync', methods=['PUT'])
+@leader_only
 def sync():
   r = monitor.try_sync()
   return r and RESPONSE.ok() or RESPONSE.fail('server busy, retry later')
 
+def serve_snapshot(name:str, view:Tuple[list, Callable]=None) -> Response:
+  # long-poll: with `If-None-Match` and `?wait=<seconds>`, hold the request until it changes
+  # or timeout (then 304), this makes an idle client cost nearly nothing
+  # NOTE: with a `view` by `runtime_view()` or alike, it's the filtered one that should change
+  names, build = view or ([name], lambda: published[name])
+  if not all(n in published for n in names): return RESPONSE.fail('not ready yet, retry later')   # a follower started before the leader
+
+  try:
+    wait = min(number_arg(request.args, 'wait') or 0, LONGPOLL_TIMEOUT)
+  except ValueError:
+    return RESPONSE.fail('parameter wrong')
+
+  snaps = [published[n] for n in names]
+  snap = build()
+  deadline = monotonic() + wait
+  while wait > 0 and snap.etag in request.if_none_match:
+    left = deadline - monotonic()
+    if left <= 0 or not wait_published(lambda: any(published[n] is not s for n, s in zip(names, snaps)), left): break
+    snaps = [published[n] for n in names]
+    snap = build()
+  return RESPONSE.cached(snap)
+
 @app.route('/runtime', methods=['GET'])
 def runtime():
-  r = to_serializable(gpu_runtime)
-  return RESPONSE.ok(r)
+  if not request.args.keys() - {'wait'}: return serve_snapshot('runtime')
+
+  try:
+    view = runtime_view(request.args)
+  except ValueError as e:
+    return RESPONSE.fail(f'parameter wrong: {e}')
+  return serve_snapshot('runtime', view)
+
+@app.route('/pool', methods=['GET'])
+@leader_only
+def pool():
+  return RESPONSE.ok(monitor.backend.stats())
+
+@app.route('/locks', methods=['GET'])
+@leader_only
+def locks():
+  return RESPONSE.ok(lock_stats())
+
+@app.route('/metrics', methods=['GET'])
+@leader_only
+def metrics():
+  return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/profile', methods=['GET', 'PUT', 'DELETE'])
+@leader_only
+def profile():
+  # PUT `?seconds=<float>` to start sampling, DELETE to stop, GET the collapsed stacks (feed to `flamegraph.pl`)
+  if request.method == 'PUT':
+    try:
+      seconds = min(float(request.args.get('seconds', PROFILER_MAX_SECONDS)), PROFILER_MAX_SECONDS)
+      assert seconds > 0
+    except:
+      return RESPONSE.fail('parameter wrong')
+    profiler.start(seconds)
+    return RESPONSE.ok()
+  elif request.method == 'DELETE':
+    profiler.stop()
+    return RESPONSE.ok()
+  else:
+    return Response(profiler.dump(), mimetype='text/plain')
 
 @app.route('/quota', methods=['GET'])
 def quota():
-  username = request.args.get('username')
+  if not request.args.keys() - {'wait'}: return serve_snapshot('quota')
+
+  try:
+    view = quota_view(request.args)
+  except ValueError as e:
+    return RESPONSE.fail(f'parameter wrong: {e}')
+
+  usernames = split_arg(request.args, 'username')
+  if usernames and 'quota' in published and usernames.isdisjoint(published['quota'].data):
+    return RESPONSE.fail(f'username {", ".join(map(repr, sorted(usernames)))} not found')
+  return serve_snapshot('quota', view)
+
+@app.route('/quota/reload', methods=['POST'])
+@leader_only
+@admin_only
+def quota_reload():
+  # apply the modified QUOTA_INIT_FILE right now, rather than waiting for the watch
+  try:
+    return RESPONSE.ok(monitor.reload_quota())
+  except Exception as e:
+    logger.error(format_exc())
+    return RESPONSE.fail(f'server internal error: {e}')
+
+@app.route('/quota/adjust', methods=['POST'])
+@leader_only
+@admin_only
+def quota_adjust():
+  try:
+    data = request.json
+    deltas = {str(k): float(v) for k, v in data['deltas'].items()}   # {'username': hours}, + to grant, - to debit
+    reason = data.get('reason')
+    assert deltas and all(isfinite(v) for v in deltas.values())
+  except:
+    logger.error(f'postdata: {request.get_data()!r}')
+    return RESPONSE.fail('parameter wrong')
+
+  try:
+    return RESPONSE.ok(monitor.adjust_quota(deltas, reason))
+  except KeyError as e:
+    return RESPONSE.fail(e.args[0])
+  except Exception as e:
+    logger.error(format_exc())
+    return RESPONSE.fail(f'server internal error: {e}')
+
+@app.route('/events', methods=['GET'])
+def events():
+  # server-sent events, push the whole `RESPONSE.ok(data)` body of a topic once it changes
+  topics = [t for t in request.args.get('topics', 'runtime,quota').split(',') if t in published]
+  if not topics: return RESPONSE.fail('no valid topics')
+
+  # NOTE: a stream holds a server thread as long as the client stays, so keep some threads for other routes,
+  # and the refused clients should poll instead, like the web page does
+  global sse_streams
+  with sse_lock:
+    if sse_streams >= SSE_MAX_STREAMS: return RESPONSE.fail('too many event streams, poll instead'), 503
+    sse_streams += 1
+
+  def release():
+    global sse_streams
+    with sse_lock: sse_streams -= 1
+
+  def stream():
+    seen = { }    # {'topic': Snapshot}
+    while True:
+      for topic in topics:
+        snap = published[topic]
+        if seen.get(topic) is not snap:
+          seen[topic] = snap
+          yield f'event: {topic}\nid: {snap.version}\ndata: {snap.body.decode()}\n\n'
+      if not wait_published(lambda: any(published[t] is not seen[t] for t in topics), SSE_KEEPALIVE):
+        yield ': keepalive\n\n'   # NOTE: a comment line, to detect dead clients & keep proxies from closing us
+
+  resp = Response(stream(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+  resp.call_on_close(release)   # NOTE: rather than `finally` in `stream()`, which never runs if it never starts
+  return resp
+
+@app.route('/history', methods=['GET'])
+@leader_only
+def history():
+  # ?since=<ts|isoformat>&until=<ts|isoformat>&host=<hostname>&gpu=<gpu_id>&user=<username>, default the last 24 hours
+  if not monitor.history: return RESPONSE.fail('history is disabled')
+
+  def parse_time(s:str, default:float) -> float:
+    if not s: return default
+    try:    return float(s)
+    except: return datetime.timestamp(datetime.fromisoformat(s))
+
+  try:
+    until = parse_time(request.args.get('until'), now_ts())
+    since = parse_time(request.args.get('since'), until - 24 * 3600)
+    gpu_id = request.args.get('gpu')
+    if gpu_id is not None: gpu_id = int(gpu_id)
+  except:
+    return RESPONSE.fail('parameter wrong')
 
   try:
-    r = monitor.query_quota(username)
-    if r: return RESPONSE.ok(r)
-    else: return RESPONSE.fail(f'username {username!r} not found')
+    rows = monitor.history.query(since, until, request.args.get('host'), gpu_id, request.args.get('user'))
+    return RESPONSE.ok(monitor.history.to_columns(rows))
+  except Exception as e:
+    logger.error(format_exc())
+    return RESPONSE.fail(f'server internal error: {e}')
+
+@app.route('/report', methods=['GET'])
+@leader_only
+def report():
+  # ?days=<float>, the window for burn rate & usage by host
+  try:
+    days = float(request.args.get('days', REPORT_WINDOW))
+    assert days > 0
+  except:
+    return RESPONSE.fail('parameter wrong')
+
+  try:
+    return RESPONSE.ok(monitor.report.build(days))
   except Exception as e:
     logger.error(format_exc())
     return RESPONSE.fail(f'server internal error: {e}')
 
 @app.route('/realloc', methods=['POST'])
+@leader_only
 def realloc():
   try:
     data = request.json
     username = b64decode(data.get('username').encode()).decode()
     password = b64decode(data.get('password').encode()).decode()
     gpu_count = int(data.get('gpu_count'))
+    queue_timeout = min(max(float(data.get('queue_timeout', REALLOC_QUEUE_TIMEOUT)), 0), REALLOC_QUEUE_TIMEOUT)
     assert None not in [username, password, gpu_count]
+    assert 0 < gpu_count <= MAX_REALLOC_COUNT
   except:
     logger.error(f'postdata: {data}')
     return RESPONSE.fail('parameter wrong')
   
+  # NOTE: runs off the request thread, client should poll `GET /realloc/<job_id>` for the result
   try: 
-    r = monitor.alloc_gpu(username, password, gpu_count)
-    return type(r) == str and RESPONSE.fail(r) or RESPONSE.ok(r)
+    job = monitor.realloc.submit(username, password, gpu_count, queue_timeout)
+    return RESPONSE.ok({'job_id': job.id})
+  except Exception as e:
+    logger.error(format_exc())
+    return RESPONSE.fail(f'server internal error: {e}')
+
+@app.route('/realloc/<job_id>', methods=['GET'])
+@leader_only
+def realloc_job(job_id):
+  job = monitor.realloc.get(job_id)
+  if not job: return RESPONSE.fail(f'job {job_id!r} not found')
+
+  # long-poll: with `?wait=<seconds>&since=<progress_cnt>`, hold the request until the job goes further
+  try:
+    wait = min(number_arg(request.args, 'wait') or 0, LONGPOLL_TIMEOUT)
+    since = number_arg(request.args, 'since', int) or 0
+  except ValueError:
+    return RESPONSE.fail('parameter wrong')
+  if wait > 0 and not job.finished:
+    monitor.realloc.wait(job, since, wait)
+  return RESPONSE.ok(job.to_dict())
+
+@app.route('/shard/report', methods=['POST'])
+@leader_only
+@shard_only('aggregator')
+def shard_report():
+  # aggregator: a shard reports its hosts & usage
+  try:
+    return RESPONSE.ok({'acked': monitor.absorb(request.json)})
+  except Exception as e:
+    logger.error(format_exc())
+    return RESPONSE.fail(f'server internal error: {e}')
+
+@app.route('/shard/kill', methods=['POST'])
+@leader_only
+@shard_only('shard')
+def shard_kill():
+  # shard: the aggregator preempts on a host of ours
+  try:
+    data = request.json
+    sock = (data['host'], int(data['port']))
+    if sock not in TRACKED_SOCKETS: return RESPONSE.fail(f'{sock_to_hostport(sock)} is not ours'), 403
+    r = monitor.kill_gpus(sock, data['gpu_ids'])
+    new_timer(0, lambda: monitor.sync([sock])).start()    # report the freed cards at once
+    return RESPONSE.ok(r)
+  except Exception as e:
+    logger.error(format_exc())
+    return RESPONSE.fail(f'server internal error: {e}')
+
+@app.route('/shard/topology', methods=['GET'])
+@leader_only
+@shard_only('shard')
+def shard_topology():
+  # shard: the aggregator asks `nvidia-smi topo -m` of a host of ours
+  try:
+    sock = (request.args['host'], int(request.args['port']))
+    if sock not in TRACKED_SOCKETS: return RESPONSE.fail(f'{sock_to_hostport(sock)} is not ours'), 403
+    return RESPONSE.ok(monitor.backend.topology(sock))
   except Exception as e:
     logger.error(format_exc())
     return RESPONSE.fail(f'server internal error: {e}')
@@ -496,16 +3063,12 @@ def realloc():
 # main entry
 
 if __name__ == '__main__':
-  init_logger()
-  monitor = GpuMonitor()
-  
+  # NOTE: the dev server of werkzeug in a single process, see `create_app()` for the production way
   try:
-    monitor.start()
+    create_app(standalone=True)
     host, port = BIND_SOCKET
-    app.run(host=host, port=port, debug=False)
+    app.run(host=host, port=port, debug=False, threaded=True)
   except KeyboardInterrupt:
     logger.info('exit by Ctrl+C')
   except Exception:
     logger.error(format_exc())
-  finally:
-    monitor.stop()
@@ -4,6 +4,7 @@
 
 import os
 from random import random, randrange, sample
+from uuid import uuid4
 from typing import Union
 from collections import defaultdict
 from traceback import format_exc
@@ -37,6 +38,8 @@ gpu_runtime['server3'][1] = {}
 gpu_runtime['server3'][2] = {'somebody'}
 gpu_runtime['server3'][3] = {}
 
+realloc_jobs = { }
+
 
 ##############################################################################
 # utils
@@ -97,14 +100,21 @@ def realloc():
   
   try:
     x = random()
-    if   x < 0.1: r = 'wrong username/password'
-    elif x < 0.3: r = 'resource not available'
-    else:         r = {'hostname': f'server{randrange(5)}', 'gpu_ids': sorted(sample(list(range(8)), gpu_count))}
-    return type(r) == str and RESPONSE.fail(r) or RESPONSE.ok(r)
+    job = {'id': uuid4().hex, 'username': username, 'gpu_count': gpu_count, 'progress': ['looking for free GPUs']}
+    if   x < 0.1: job.update({'state': 'failed', 'reason': 'wrong username/password'})
+    elif x < 0.3: job.update({'state': 'failed', 'reason': 'resource not available'})
+    else:         job.update({'state': 'done', 'result': {'hostname': f'server{randrange(5)}', 'gpu_ids': sorted(sample(list(range(8)), gpu_count))}})
+    realloc_jobs[job['id']] = job
+    return RESPONSE.ok({'job_id': job['id']})
   except Exception as e:
     print(format_exc())
     return RESPONSE.fail(f'server internal error: {e}')
 
+@app.route('/realloc/<job_id>', methods=['GET'])
+def realloc_job(job_id):
+  if job_id in realloc_jobs: return RESPONSE.ok(realloc_jobs[job_id])
+  else: return RESPONSE.fail(f'job {job_id!r} not found')
+
 
 ##############################################################################
 # main entry
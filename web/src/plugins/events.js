@@ -0,0 +1,27 @@
+import hp from '../plugins/settings'
+
+// one shared server-sent events stream for all components
+// REFER: sodayo `GET /events`
+let source = null
+
+let fallbacks = [ ]
+
+// call `callback(r)` with the parsed `{ok, data}` body, each time the server pushes a change of `topic`
+// or call `fallback()` once to poll instead, if the browser does not support it, or the server refuses (too many streams)
+const subscribe = (topic, callback, fallback) => {
+  if (!window.EventSource) return fallback()
+
+  if (source == null) {
+    source = new EventSource(hp.API_BASE + '/events?topics=runtime,quota')
+    // NOTE: closed for good on a non-200 response, while a broken connection is retried by the browser
+    source.onerror = () => {
+      if (source.readyState != EventSource.CLOSED) return
+      fallbacks.forEach(fn => fn())
+      fallbacks = [ ]
+    }
+  }
+  source.addEventListener(topic, e => callback(JSON.parse(e.data)))
+  fallbacks.push(fallback)
+}
+
+export default subscribe
\ No newline at end of file